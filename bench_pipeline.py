@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2016, Christopher Atherton <the8lack8ox@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import time
+
+import argparse
+import datetime
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+
+import bench_tags
+import chaud
+
+STUB_SOURCE = r'''
+import os
+import sys
+import time
+
+name = os.path.basename( sys.argv[0] )
+args = sys.argv[1:]
+rate = float( os.environ.get( 'CHAUD_STUB_RATE', '0' ) )
+cpu = float( os.environ.get( 'CHAUD_STUB_CPU', '0' ) )
+pcm_size = int( os.environ.get( 'CHAUD_STUB_PCM', '65536' ) )
+start = time.time()
+
+def burn():
+	end = time.process_time() + cpu
+	while time.process_time() < end:
+		pass
+
+def throttle( done ):
+	if rate > 0:
+		delay = start + done / rate - time.time()
+		if delay > 0:
+			time.sleep( delay )
+
+def output_path():
+	for i, arg in enumerate( args ):
+		if arg.startswith( '--output-name=' ) or arg.startswith( '--output=' ):
+			return arg.split( '=', 1 )[1]
+		if arg in ( '-o', '-of' ) and i + 1 < len( args ) and args[i+1] != '-':
+			return args[i+1]
+	return args[-1]
+
+if '--help' in args:
+	# Probed by chaud for version dependent options
+	print( 'usage: ' + name + ' [options]' )
+elif name in ( 'opusdec', 'oggdec', 'wvunpack', 'neroAacDec' ) or '--decode' in args:
+	burn()
+	chunk = bytes( 1 << 16 )
+	done = 0
+	try:
+		while done < pcm_size:
+			count = min( len( chunk ), pcm_size - done )
+			sys.stdout.buffer.write( chunk[0:count] )
+			done += count
+			throttle( done )
+		sys.stdout.buffer.flush()
+	except BrokenPipeError:
+		sys.exit( 1 )
+elif name in ( 'flac', 'lame', 'opusenc', 'oggenc', 'wavpack', 'fdkaac', 'faac', 'neroAacEnc' ):
+	done = 0
+	while True:
+		data = sys.stdin.buffer.read1( 1 << 16 )
+		if len( data ) == 0:
+			break
+		done += len( data )
+		throttle( done )
+	burn()
+	with open( output_path(), 'wb' ) as out_file:
+		out_file.write( bytes( 1024 ) )
+	if 'CHAUD_STUB_LOG' in os.environ:
+		with open( os.environ['CHAUD_STUB_LOG'], 'a' ) as log_file:
+			log_file.write( '{} {}\n'.format( start, time.time() ) )
+'''
+"""Fake codec: decoders write silence, encoders drain stdin (both rate limited and burning CPU), taggers do nothing, --help prints a usage line"""
+
+STUB_NAMES = ( 'flac', 'lame', 'opusenc', 'opusdec', 'oggenc', 'oggdec', 'wavpack', 'wvunpack', 'fdkaac', 'neroAacDec', 'metaflac', 'vorbiscomment', 'neroAacTag', 'MP4Box' )
+"""Codec and tagging tools replaced by the fake"""
+
+FILES_PER_DIRECTORY = 100
+"""Files per directory of the generated tree, an album-sized listing"""
+
+CHILD_SOURCE = r'''
+import json
+import resource
+import sys
+
+sys.path.insert( 0, sys.argv[1] )
+import chaud
+
+status = chaud.main( sys.argv[3:] )
+usage = resource.getrusage( resource.RUSAGE_SELF )
+children = resource.getrusage( resource.RUSAGE_CHILDREN )
+with open( sys.argv[2], 'w' ) as stats_file:
+	json.dump( { 'status': status, 'cpu': usage.ru_utime + usage.ru_stime, 'peak_rss': usage.ru_maxrss, 'codec_cpu': children.ru_utime + children.ru_stime }, stats_file )
+sys.exit( status )
+'''
+"""Runs chaud.main() and records its own CPU time and peak RSS apart from those of the codecs"""
+
+
+#
+# Setup functions
+#
+
+
+def install_stubs( directory ):
+	"""Write the fake codec and link it under the name of every tool it replaces"""
+	stub_path = os.path.join( directory, 'chaud-stub-codec' )
+	with open( stub_path, 'w' ) as stub_file:
+		stub_file.write( '#!' + sys.executable + ' -S\n' + STUB_SOURCE )
+	os.chmod( stub_path, 0o755 )
+	for name in STUB_NAMES:
+		os.symlink( stub_path, os.path.join( directory, name ) )
+
+
+def make_tree( directory, count, in_format ):
+	"""Generate a tree of small tagged source files in directories of album size"""
+	audio = bytes( 4096 )
+	for i in range( count ):
+		album = i // FILES_PER_DIRECTORY
+		if i % FILES_PER_DIRECTORY == 0:
+			os.mkdir( os.path.join( directory, 'album-' + str( album ).zfill( 6 ) ) )
+		fields = dict( bench_tags.FIELDS, title='Track ' + str( i ), album='Album ' + str( album ), track=i % FILES_PER_DIRECTORY + 1 )
+		if in_format == 'flac':
+			data = bench_tags.make_flac( fields, audio )
+		elif in_format == 'mp3':
+			data = chaud.write_id3v2_header( audio, fields )
+		else:
+			data = b'RIFF' + audio
+		with open( os.path.join( directory, 'album-' + str( album ).zfill( 6 ), 'track-' + str( i % FILES_PER_DIRECTORY ).zfill( 3 ) + '.' + in_format ), 'wb' ) as out_file:
+			out_file.write( data )
+
+
+#
+# Benchmark functions
+#
+
+
+def run_chaud( tree, files, in_format, out_root, transcodes, jobs, env, stats_path, log_path ):
+	"""Run chaud over the tree of files and measure it"""
+	out_paths = [ os.path.join( out_root, transcode ) for transcode in transcodes ]
+	args = [ '--no-nice', '-r', '-j', str( jobs ) ]
+	for transcode in transcodes:
+		args += [ '-x', transcode ]
+	args += [ tree ] + out_paths
+	if os.path.exists( log_path ):
+		os.remove( log_path )
+
+	start = time.perf_counter()
+	status = subprocess.call( [ sys.executable, '-c', CHILD_SOURCE, os.path.dirname( os.path.abspath( chaud.__file__ ) ), stats_path ] + args, env=env, stdout=subprocess.DEVNULL )
+	wall = time.perf_counter() - start
+
+	stats = { 'peak_rss': None, 'cpu': None, 'codec_cpu': None }
+	# Missing if chaud crashed
+	if os.path.exists( stats_path ):
+		with open( stats_path ) as stats_file:
+			stats = json.load( stats_file )
+		os.remove( stats_path )
+	busy = 0.0
+	encodes = 0
+	if os.path.exists( log_path ):
+		with open( log_path ) as log_file:
+			for line in log_file:
+				begin, end = map( float, line.split() )
+				busy += end - begin
+				encodes += 1
+	for out_path in out_paths:
+		shutil.rmtree( out_path, ignore_errors=True )
+	# Targets in the format of the sources are copied, not encoded
+	encoders = len( [ transcode for transcode in transcodes if chaud.FORMAT_EXT_MAP[transcode] != '.' + in_format ] )
+
+	return {
+		'jobs':					jobs,
+		'status':				status,
+		'wall_seconds':			wall,
+		'encodes':				encodes,
+		'files_per_second':		files / wall,
+		# Share of the run during which the job slots had their encoders running
+		'worker_utilisation':	busy / ( wall * jobs * max( encoders, 1 ) ),
+		'peak_rss_kib':			stats['peak_rss'],
+		'cpu_seconds':			stats['cpu'],
+		'codec_cpu_seconds':	stats['codec_cpu']
+	}
+
+
+#
+# Program entry point
+#
+
+
+def main( argv=None ):
+	# Parse command line
+	command_line_parser = argparse.ArgumentParser( description='benchmark the orchestration of chaud with fake codecs' )
+	command_line_parser.add_argument( '-n', '--files', type=int, default=10000, help='files in the generated tree (default: %(default)s)', metavar='INT' )
+	command_line_parser.add_argument( '-j', '--jobs', default=','.join( map( str, sorted( { 1, 2, 4, chaud.THREAD_COUNT } ) ) ), help='comma separated --jobs settings to compare (default: %(default)s)', metavar='INTS' )
+	command_line_parser.add_argument( '-f', '--format', choices=( 'flac', 'mp3', 'wav' ), default='flac', help='format of the generated sources (default: %(default)s)' )
+	command_line_parser.add_argument( '-x', '--transcode', action='append', choices=chaud.FORMAT_EXT_MAP.keys(), help='formats chaud transcodes to (default: mp3)' )
+	command_line_parser.add_argument( '--rate', type=float, default=0, help='bytes per second the fake codecs read or write, 0 for unlimited (default: %(default)s)', metavar='FLOAT' )
+	command_line_parser.add_argument( '--cpu', type=float, default=0, help='CPU seconds each fake codec process burns (default: %(default)s)', metavar='FLOAT' )
+	command_line_parser.add_argument( '--pcm', type=int, default=1 << 16, help='bytes of PCM each fake decoder writes (default: %(default)s)', metavar='BYTES' )
+	command_line_parser.add_argument( '--tree', help='generate the tree in (or reuse it from) this directory instead of a temporary one', metavar='DIRECTORY' )
+	command_line_parser.add_argument( '-o', '--output', default='-', help='write the JSON report to a file (default: standard output)', metavar='FILENAME' )
+	if argv is None:
+		command_line = command_line_parser.parse_args()
+	else:
+		command_line = command_line_parser.parse_args( argv )
+	transcodes = command_line.transcode or [ 'mp3' ]
+
+	results = list()
+	with tempfile.TemporaryDirectory( prefix='chaud-bench-' ) as directory:
+		bin_path = os.path.join( directory, 'bin' )
+		os.mkdir( bin_path )
+		install_stubs( bin_path )
+
+		tree = command_line.tree or os.path.join( directory, 'tree' )
+		if not os.path.exists( tree ):
+			os.mkdir( tree )
+			start = time.perf_counter()
+			make_tree( tree, command_line.files, command_line.format )
+			print( 'Generated', command_line.files, 'files in', round( time.perf_counter() - start, 1 ), 'seconds', file=sys.stderr, flush=True )
+		# A reused tree may hold a different number of files
+		files = sum( len( filenames ) for dirpath, dirnames, filenames in os.walk( tree ) )
+
+		log_path = os.path.join( directory, 'encodes.log' )
+		env = dict( os.environ, PATH=bin_path + os.pathsep + os.environ.get( 'PATH', '' ), CHAUD_STUB_RATE=str( command_line.rate ), CHAUD_STUB_CPU=str( command_line.cpu ), CHAUD_STUB_PCM=str( command_line.pcm ), CHAUD_STUB_LOG=log_path )
+		out_root = os.path.join( directory, 'out' )
+		os.mkdir( out_root )
+		for jobs in map( int, command_line.jobs.split( ',' ) ):
+			result = run_chaud( tree, files, command_line.format, out_root, transcodes, jobs, env, os.path.join( directory, 'stats.json' ), log_path )
+			results.append( result )
+			print( 'jobs', str( jobs ).rjust( 3 ), '{:10.2f} s'.format( result['wall_seconds'] ), '{:9.1f} files/s'.format( result['files_per_second'] ), '{:6.1%} busy'.format( result['worker_utilisation'] ), '{} KiB'.format( result['peak_rss_kib'] ), file=sys.stderr, flush=True )
+
+	report = {
+		'date':			datetime.datetime.utcnow().replace( microsecond=0 ).isoformat(),
+		'python':		platform.python_implementation() + ' ' + platform.python_version(),
+		'platform':		platform.platform(),
+		'cpus':			chaud.THREAD_COUNT,
+		'files':		files,
+		'format':		command_line.format,
+		'transcode':	transcodes,
+		'rate':			command_line.rate,
+		'cpu':			command_line.cpu,
+		'pcm':			command_line.pcm,
+		'results':		results
+	}
+	if command_line.output == '-':
+		json.dump( report, sys.stdout, indent='\t' )
+		print()
+	else:
+		with open( command_line.output, 'w', encoding='utf_8' ) as report_file:
+			json.dump( report, report_file, indent='\t' )
+	return 0
+
+if __name__ == '__main__':
+	sys.exit( main() )
+
+# vim: ts=4:sw=4:noet:si
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2016, Christopher Atherton <the8lack8ox@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import tempfile
+import timeit
+
+import chaud
+
+FIELDS = {
+	'title':	'Synthetic Benchmark Title',
+	'artist':	'Synthetic Artist',
+	'album':	'Synthetic Album',
+	'track':	7,
+	'disc':		1,
+	'genre':	'Rock',
+	'year':		2016,
+	'comment':	'generated by bench_tags.py'
+}
+"""Tag fields written to every file of the corpus"""
+
+PAYLOAD_SIZES = ( 1 << 16, 1 << 22 )
+"""Sizes of the (random) audio payloads of the corpus"""
+
+COVER_SIZE = 1 << 16
+"""Size of the front cover embedded in the files with a cover"""
+
+
+#
+# Corpus functions
+#
+
+
+def make_picture( size ):
+	"""Create a PNG header padded to the size, enough for probe_image"""
+	header = b'\x89PNG\r\n\x1a\n' + ( 13 ).to_bytes( 4, 'big' ) + b'IHDR' + ( 500 ).to_bytes( 4, 'big' ) + ( 500 ).to_bytes( 4, 'big' ) + bytes( ( 8, 2, 0, 0, 0 ) ) + bytes( 4 )
+	return header + bytes( size - len( header ) )
+
+
+def make_id3v1( fields, plus=False ):
+	"""Create an ID3v1.1 tag, preceded by an extended TAG+ block if asked"""
+	def text( value, size ):
+		return str( value ).encode( 'ascii' )[0:size].ljust( size, b'\x00' )
+	genre = chaud.ID3V1_GENRES.index( fields['genre'] )
+	tag = b'TAG' + text( fields['title'], 30 ) + text( fields['artist'], 30 ) + text( fields['album'], 30 ) + text( fields['year'], 4 ) + text( fields['comment'], 28 ) + bytes( ( 0, fields['track'], genre ) )
+	if plus:
+		# The extended block holds what does not fit the basic tag
+		tag = b'TAG+' + text( fields['title'][30:], 60 ) + text( fields['artist'][30:], 60 ) + text( fields['album'][30:], 60 ) + b'\x00' + text( fields['genre'], 30 ) + bytes( 12 ) + tag
+	return tag
+
+
+def make_id3v2_frames( fields, version, picture=None ):
+	"""Encode the fields as ID3v2.2, ID3v2.3 or ID3v2.4 frames"""
+	if version == 4:
+		return b''.join( chaud.write_id3v2_frames( dict( fields, **( { 'cover': picture } if picture is not None else {} ) ) ) )
+
+	frames = list()
+	for name, frame_id in ( ( 'title', 'TIT2' ), ( 'artist', 'TPE1' ), ( 'album', 'TALB' ), ( 'track', 'TRCK' ), ( 'disc', 'TPOS' ), ( 'genre', 'TCON' ), ( 'year', 'TYER' ) ):
+		frames.append( ( frame_id, b'\x01' + str( fields[name] ).encode( 'utf_16' ) ) )
+	frames.append( ( 'COMM', b'\x00eng\x00' + fields['comment'].encode( 'latin_1' ) ) )
+	if picture is not None:
+		frames.append( ( 'APIC', b'\x00image/png\x00\x03\x00' + picture ) )
+
+	if version == 3:
+		return b''.join( frame_id.encode( 'ascii' ) + len( payload ).to_bytes( 4, 'big' ) + b'\x00\x00' + payload for frame_id, payload in frames )
+	# ID3v2.2 has three character identifiers and sizes
+	v22_ids = { 'TIT2': 'TT2', 'TPE1': 'TP1', 'TALB': 'TAL', 'TRCK': 'TRK', 'TPOS': 'TPA', 'TCON': 'TCO', 'TYER': 'TYE', 'COMM': 'COM' }
+	data = bytes()
+	for frame_id, payload in frames:
+		if frame_id == 'APIC':
+			frame_id, payload = 'PIC', b'\x00PNG\x03\x00' + picture
+		else:
+			frame_id = v22_ids[frame_id]
+		data += frame_id.encode( 'ascii' ) + len( payload ).to_bytes( 3, 'big' ) + payload
+	return data
+
+
+def make_id3v2( fields, version, picture=None, footer=False ):
+	"""Create an ID3v2 tag, with a footer (3DI) for an ID3v2.4 tag appended to the audio"""
+	frames = make_id3v2_frames( fields, version, picture )
+	flags = 0x10 if footer else 0x00
+	tag = b'ID3' + bytes( ( version, 0, flags ) ) + chaud.encode_synchsafe_int( len( frames ) ) + frames
+	if footer:
+		tag += b'3DI' + bytes( ( version, 0, flags ) ) + chaud.encode_synchsafe_int( len( frames ) )
+	return tag
+
+
+def make_flac( fields, audio, picture=None ):
+	"""Create a FLAC file with a VORBIS_COMMENT block and optionally a front cover PICTURE block"""
+	blocks = [ ( 0, bytes( 34 ) ), ( 4, chaud.write_vorbis_comment( fields ) ) ]
+	if picture is not None:
+		blocks.append( ( 6, chaud.write_metadatablockpicture( picture ) ) )
+	blocks.append( ( 1, bytes( 1024 ) ) )
+	data = b'fLaC'
+	for i, ( block_type, block ) in enumerate( blocks ):
+		data += bytes( ( block_type | ( 0x80 if i == len( blocks ) - 1 else 0 ), ) ) + len( block ).to_bytes( 3, 'big' ) + block
+	return data + audio
+
+
+def make_ogg( packets ):
+	"""Lay packets out in Ogg pages of a single logical stream (without checksums)"""
+	data = bytes()
+	sequence = 0
+	for packet in packets:
+		segments = [ 255 ] * ( len( packet ) // 255 ) + [ len( packet ) % 255 ]
+		pos = 0
+		while len( segments ) > 0:
+			page_segments, segments = segments[0:255], segments[255:]
+			size = sum( page_segments )
+			data += b'OggS' + bytes( 10 ) + ( 1 ).to_bytes( 4, 'little' ) + sequence.to_bytes( 4, 'little' ) + bytes( 4 ) + bytes( ( len( page_segments ), ) ) + bytes( page_segments ) + packet[pos:pos+size]
+			pos += size
+			sequence += 1
+	return data
+
+
+def make_mp4_box( name, payload ):
+	"""Create an MP4 box"""
+	return ( 8 + len( payload ) ).to_bytes( 4, 'big' ) + name + payload
+
+
+def make_mp4( fields, audio, picture=None ):
+	"""Create an M4A file with an iTunes metadata list after the media data"""
+	def item( name, flags, value ):
+		return make_mp4_box( name, make_mp4_box( b'data', flags.to_bytes( 4, 'big' ) + bytes( 4 ) + value ) )
+	items = item( b'\xa9nam', 1, fields['title'].encode( 'utf_8' ) ) + item( b'\xa9ART', 1, fields['artist'].encode( 'utf_8' ) ) + item( b'\xa9alb', 1, fields['album'].encode( 'utf_8' ) )
+	items += item( b'trkn', 0, bytes( 2 ) + fields['track'].to_bytes( 2, 'big' ) + bytes( 4 ) ) + item( b'\xa9day', 1, str( fields['year'] ).encode( 'ascii' ) )
+	if picture is not None:
+		items += item( b'covr', 14, picture )
+	meta = bytes( 4 ) + make_mp4_box( b'hdlr', bytes( 25 ) ) + make_mp4_box( b'ilst', items )
+	moov = make_mp4_box( b'moov', make_mp4_box( b'mvhd', bytes( 100 ) ) + make_mp4_box( b'udta', make_mp4_box( b'meta', meta ) ) )
+	return make_mp4_box( b'ftyp', b'M4A ' + bytes( 4 ) ) + make_mp4_box( b'mdat', audio ) + moov
+
+
+def make_apev2( fields, audio ):
+	"""Create a WavPack-like file ending with an APEv2 tag"""
+	items = bytes()
+	for name, key in ( ( 'Title', 'title' ), ( 'Artist', 'artist' ), ( 'Album', 'album' ), ( 'Track', 'track' ), ( 'Genre', 'genre' ), ( 'Year', 'year' ), ( 'Comment', 'comment' ) ):
+		value = str( fields[key] ).encode( 'utf_8' )
+		items += len( value ).to_bytes( 4, 'little' ) + bytes( 4 ) + name.encode( 'ascii' ) + b'\x00' + value
+	def header( flags ):
+		return b'APETAGEX' + ( 2000 ).to_bytes( 4, 'little' ) + ( len( items ) + 32 ).to_bytes( 4, 'little' ) + ( 7 ).to_bytes( 4, 'little' ) + flags.to_bytes( 4, 'little' ) + bytes( 8 )
+	return b'wvpk' + audio + header( 0xA0000000 ) + items + header( 0x80000000 )
+
+
+def build_corpus( directory, size ):
+	"""Build the in-memory samples and files of the corpus for a payload size"""
+	audio = os.urandom( size )
+	picture = make_picture( COVER_SIZE )
+
+	samples = {
+		'id3v1':				audio + make_id3v1( FIELDS ),
+		'id3v1+tag+':			audio + make_id3v1( FIELDS, plus=True ),
+		'id3v2.2':				make_id3v2( FIELDS, 2 ) + audio,
+		'id3v2.3':				make_id3v2( FIELDS, 3 ) + audio,
+		'id3v2.3+cover':		make_id3v2( FIELDS, 3, picture ) + audio,
+		'id3v2.4':				make_id3v2( FIELDS, 4 ) + audio,
+		'id3v2.4+cover':		make_id3v2( FIELDS, 4, picture ) + audio,
+		'id3v2.4-footer':		audio + make_id3v2( FIELDS, 4, footer=True ),
+		'id3v2.4-footer+id3v1':	audio + make_id3v2( FIELDS, 4, footer=True ) + make_id3v1( FIELDS )
+	}
+
+	files = {
+		'mp3-id3v1':			( '.mp3', samples['id3v1'] ),
+		'mp3-id3v2.2':			( '.mp3', samples['id3v2.2'] ),
+		'mp3-id3v2.3+cover':	( '.mp3', samples['id3v2.3+cover'] ),
+		'mp3-id3v2.4+cover':	( '.mp3', samples['id3v2.4+cover'] + make_id3v1( FIELDS ) ),
+		'mp3-id3v2.4-footer':	( '.mp3', samples['id3v2.4-footer'] ),
+		'flac':					( '.flac', make_flac( FIELDS, audio ) ),
+		'flac+cover':			( '.flac', make_flac( FIELDS, audio, picture ) ),
+		'ogg-vorbis':			( '.ogg', make_ogg( ( b'\x01vorbis' + bytes( 23 ), b'\x03vorbis' + chaud.write_vorbis_comment( FIELDS ) + b'\x01', b'\x05vorbis' + bytes( 50 ), audio ) ) ),
+		'ogg-opus':				( '.opus', make_ogg( ( b'OpusHead' + bytes( 11 ), b'OpusTags' + chaud.write_vorbis_comment( FIELDS ), audio ) ) ),
+		'm4a+cover':			( '.m4a', make_mp4( FIELDS, audio, picture ) ),
+		'wv-apev2':				( '.wv', make_apev2( FIELDS, audio ) )
+	}
+	paths = dict()
+	for name, ( ext, data ) in files.items():
+		paths[name] = os.path.join( directory, name + '-' + str( size ) + ext )
+		with open( paths[name], 'wb' ) as out_file:
+			out_file.write( data )
+
+	return samples, paths, chaud.write_metadatablockpicture( picture )
+
+
+#
+# Benchmark functions
+#
+
+
+def measure( func, repeat ):
+	"""Time a function like timeit, returning the calls made and the best and median seconds per call"""
+	timer = timeit.Timer( func )
+	number, elapsed = timer.autorange()
+	times = [ t / number for t in timer.repeat( repeat, number ) ]
+	return { 'calls': number * repeat, 'best': min( times ), 'median': statistics.median( times ) }
+
+
+def benchmarks( directory, size ):
+	"""Generate the ( function, case, callable ) benchmarks of a payload size"""
+	samples, paths, picture_block = build_corpus( directory, size )
+
+	for case in ( 'id3v1', 'id3v1+tag+' ):
+		yield 'read_id3v1', case, lambda data=samples[case]: chaud.read_id3v1( data )
+		yield 'remove_id3v1', case, lambda data=samples[case]: chaud.remove_id3v1( data )
+	for case in ( 'id3v2.2', 'id3v2.3', 'id3v2.3+cover', 'id3v2.4', 'id3v2.4+cover' ):
+		yield 'read_id3v2_header', case, lambda data=samples[case]: chaud.read_id3v2_header( data )
+		yield 'remove_id3v2_header', case, lambda data=samples[case]: chaud.remove_id3v2_header( data )
+	for case in ( 'id3v2.4-footer', 'id3v2.4-footer+id3v1' ):
+		yield 'read_id3v2_footer', case, lambda data=samples[case]: chaud.read_id3v2_footer( data )
+		yield 'remove_id3v2_footer', case, lambda data=samples[case]: chaud.remove_id3v2_footer( data )
+	audio = samples['id3v1'][0:size]
+	yield 'write_id3v2_header', 'text', lambda: chaud.write_id3v2_header( audio, dict( FIELDS ) )
+	picture = make_picture( COVER_SIZE )
+	yield 'write_id3v2_header', 'text+cover', lambda: chaud.write_id3v2_header( audio, dict( FIELDS, cover=picture ) )
+	yield 'read_metadatablockpicture', 'cover', lambda: chaud.read_metadatablockpicture( picture_block )
+
+	for case, path in paths.items():
+		yield 'get_tag', case, lambda path=path: chaud.get_tag( path )
+	# After the first call the tag fits its padding, so this times the in-place rewrite
+	yield 'set_tag', 'mp3-id3v2.4+cover', lambda path=paths['mp3-id3v2.4+cover']: chaud.set_tag( path, dict( FIELDS ) )
+	for case in ( 'mp3-id3v2.4+cover', 'flac+cover' ):
+		copy_path = os.path.join( directory, 'copy-' + os.path.basename( paths[case] ) )
+		yield 'copy_with_tag', case, lambda path=paths[case], copy_path=copy_path: chaud.copy_with_tag( path, copy_path, dict( FIELDS, album='Copied' ), changed=True )
+
+
+#
+# Program entry point
+#
+
+
+def main( argv=None ):
+	# Parse command line
+	command_line_parser = argparse.ArgumentParser( description='benchmark the tag codecs of chaud' )
+	command_line_parser.add_argument( '-o', '--output', default='-', help='write the JSON report to a file (default: standard output)', metavar='FILENAME' )
+	command_line_parser.add_argument( '-r', '--repeat', type=int, default=5, help='timing runs per benchmark (default: %(default)s)', metavar='INT' )
+	command_line_parser.add_argument( '-k', '--filter', help='only run benchmarks whose function or case contains the string', metavar='STRING' )
+	if argv is None:
+		command_line = command_line_parser.parse_args()
+	else:
+		command_line = command_line_parser.parse_args( argv )
+
+	results = list()
+	with tempfile.TemporaryDirectory( prefix='chaud-bench-' ) as directory:
+		for size in PAYLOAD_SIZES:
+			for function, case, func in benchmarks( directory, size ):
+				if command_line.filter is not None and command_line.filter not in function and command_line.filter not in case:
+					continue
+				result = { 'function': function, 'case': case, 'payload_size': size }
+				result.update( measure( func, command_line.repeat ) )
+				results.append( result )
+				print( function.ljust( 28 ), case.ljust( 24 ), str( size ).rjust( 8 ), '{:12.3f} us'.format( result['best'] * 1e6 ), file=sys.stderr, flush=True )
+
+	report = {
+		'date':			datetime.datetime.utcnow().replace( microsecond=0 ).isoformat(),
+		'python':		platform.python_implementation() + ' ' + platform.python_version(),
+		'platform':		platform.platform(),
+		'repeat':		command_line.repeat,
+		'results':		results
+	}
+	if command_line.output == '-':
+		json.dump( report, sys.stdout, indent='\t' )
+		print()
+	else:
+		with open( command_line.output, 'w', encoding='utf_8' ) as report_file:
+			json.dump( report, report_file, indent='\t' )
+	return 0
+
+if __name__ == '__main__':
+	sys.exit( main() )
+
+# vim: ts=4:sw=4:noet:si
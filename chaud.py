@@ -33,19 +33,56 @@ import sys
 import time
 
 import argparse
+import fcntl
 import tempfile
 import base64
+import binascii
+import collections
+import contextlib
 import datetime
-import imghdr
+import functools
+import hashlib
+import heapq
+import json
+import mmap
 import shutil
+import zlib
 
 import concurrent.futures
 import multiprocessing
 import subprocess
+import threading
 
 PROGRAM_NAME='chaud'
 
-THREAD_COUNT = multiprocessing.cpu_count()
+def available_cpu_count():
+	"""Count the CPUs this process may use, honouring its affinity mask and any cgroup CPU quota"""
+	try:
+		count = len( os.sched_getaffinity( 0 ) )
+	except AttributeError:
+		count = multiprocessing.cpu_count()
+	# cgroup v2, then v1
+	for quota_path, period_path in ( ( '/sys/fs/cgroup/cpu.max', None ), ( '/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us' ) ):
+		try:
+			with open( quota_path ) as quota_file:
+				quota = quota_file.read().split()
+			if period_path is not None:
+				with open( period_path ) as period_file:
+					quota.append( period_file.read().strip() )
+		except OSError:
+			continue
+		if quota[0] != 'max' and int( quota[0] ) > 0:
+			count = min( count, max( 1, -( -int( quota[0] ) // int( quota[1] ) ) ) )
+		break
+	return count
+
+THREAD_COUNT = available_cpu_count()
+
+COPY_CHUNK_SIZE = 1 << 20
+"""Size of the chunks audio payloads are copied in"""
+
+FICLONE = 0x40049409
+"""Linux ioctl sharing the extents of one file with another (reflink)"""
 
 tmpdir = tempfile.TemporaryDirectory( prefix=PROGRAM_NAME+'-' )
 
@@ -53,6 +90,24 @@ def free_filename( ext='.tmp' ):
 	with tempfile.NamedTemporaryFile( suffix=ext, dir=tmpdir.name ) as tf:
 		return tf.name
 
+COVER_CACHE_BUDGET = 64 << 20
+"""Memory budget in bytes for encoded covers kept across tracks"""
+
+cover_cache = collections.OrderedDict()
+"""Encoded covers by content hash and form, least recently used first"""
+cover_cache_size = 0
+cover_digests = dict()
+"""Content hashes of cover files by path"""
+cover_cache_lock = threading.Lock()
+
+trace_events = None
+"""Chrome trace events recorded for --trace, or None when not tracing"""
+trace_threads = dict()
+"""Names of the threads that recorded trace events, by thread id"""
+trace_lock = threading.Lock()
+trace_epoch = time.perf_counter()
+"""Time the trace timestamps count from"""
+
 FORMAT_EXT_MAP = {
 	'aac':		'.m4a',
 	'flac':		'.flac',
@@ -64,58 +119,94 @@ FORMAT_EXT_MAP = {
 }
 """Map of supported format names and extensions"""
 
-# Regular expressions for AAC tag extraction
-AAC_TITLE_RE		= re.compile( r'    title = (.+)' )
-AAC_ARTIST_RE		= re.compile( r'    artist = (.+)' )
-AAC_ALBUM_RE		= re.compile( r'    album = (.+)' )
-AAC_TRACK_RE		= re.compile( r'    track = (\d+)' )
-AAC_DISC_RE			= re.compile( r'    disc = (\d+)' )
-AAC_GENRE_RE		= re.compile( r'    genre = (.+)' )
-AAC_YEAR_RE			= re.compile( r'    year = (\d+)' )
-AAC_COMMENT_RE		= re.compile( r'    comment = (.+)' )
-
-# Regular expressions for FLAC tag extraction
-FLAC_TITLE_RE		= re.compile( r'    comment\[\d+\]: TITLE=(.+)', re.I )
-FLAC_ARTIST_RE		= re.compile( r'    comment\[\d+\]: ARTIST=(.+)', re.I )
-FLAC_ALBUM_RE		= re.compile( r'    comment\[\d+\]: ALBUM=(.+)', re.I )
-FLAC_TRACK_RE		= re.compile( r'    comment\[\d+\]: TRACKNUMBER=(\d+)', re.I )
-FLAC_DISC_RE		= re.compile( r'    comment\[\d+\]: DISCNUMBER=(\d+)', re.I )
-FLAC_GENRE_RE		= re.compile( r'    comment\[\d+\]: GENRE=(.+)', re.I )
-FLAC_YEAR_RE		= re.compile( r'    comment\[\d+\]: DATE=(\d+)(\D\d+\D\d+)?', re.I )
-FLAC_COMMENT_RE		= re.compile( r'    comment\[\d+\]: COMMENT=(.+)', re.I )
-
-# Regular expressions for OPUS tag extraction
-OPUS_TITLE_RE		= re.compile( r'\tTITLE=(.+)', re.I )
-OPUS_ARTIST_RE		= re.compile( r'\tARTIST=(.+)', re.I )
-OPUS_ALBUM_RE		= re.compile( r'\tALBUM=(.+)', re.I )
-OPUS_TRACK_RE		= re.compile( r'\tTRACKNUMBER=(\d+)', re.I )
-OPUS_DISC_RE		= re.compile( r'\tDISCNUMBER=(\d+)', re.I )
-OPUS_GENRE_RE		= re.compile( r'\tGENRE=(.+)', re.I )
-OPUS_YEAR_RE		= re.compile( r'\tDATE=(\d+)(\D\d+\D\d+)?', re.I )
-OPUS_COMMENT_RE		= re.compile( r'\tCOMMENT=(.+)', re.I )
-#OPUS_COVER_RE		= re.compile( r'\tMETADATA_BLOCK_PICTURE=(.+)', re.I )
-
-# Regular expressions for VORBIS tag extraction
-VORBIS_TITLE_RE		= re.compile( r'TITLE=(.+)', re.I )
-VORBIS_ARTIST_RE	= re.compile( r'ARTIST=(.+)', re.I )
-VORBIS_ALBUM_RE		= re.compile( r'ALBUM=(.+)', re.I )
-VORBIS_TRACK_RE		= re.compile( r'TRACKNUMBER=(\d+)', re.I )
-VORBIS_DISC_RE		= re.compile( r'DISCNUMBER=(\d+)', re.I )
-VORBIS_GENRE_RE		= re.compile( r'GENRE=(.+)', re.I )
-VORBIS_YEAR_RE		= re.compile( r'DATE=(\d+)(\D\d+\D\d+)?', re.I )
-VORBIS_COMMENT_RE	= re.compile( r'COMMENT=(.+)', re.I )
-VORBIS_COVER_RE		= re.compile( r'METADATA_BLOCK_PICTURE=(.+)', re.I )
-
-# Regular expressions for WAVPACK tag extraction
-WAVPACK_TITLE_RE	= re.compile( r'Title:\s+(.+)' )
-WAVPACK_ARTIST_RE	= re.compile( r'Artist:\s+(.+)' )
-WAVPACK_ALBUM_RE	= re.compile( r'Album:\s+(.+)' )
-WAVPACK_TRACK_RE	= re.compile( r'Track:\s+(\d+)' )
-WAVPACK_DISC_RE		= re.compile( r'Disc:\s+(\d+)' )	# ?
-WAVPACK_GENRE_RE	= re.compile( r'Genre:\s+(.+)' )
-WAVPACK_YEAR_RE		= re.compile( r'Year:\s+(\d+)' )
-WAVPACK_COMMENT_RE	= re.compile( r'Comment:\s+(.+)' )
-WAVPACK_COVER_RE	= re.compile( r'Cover Art \(Front\):\s+(.+)' )
+ENCODER_OPTIONS = {
+	'.m4a':		{ 'fdkaac': ( '-m', '4' ), 'neroAacEnc': ( '-q', '0.4' ), 'faac': () },
+	'.flac':	{ 'flac': ( '--best', ) },
+	'.mp3':		{ 'lame': ( '-V', '0' ) },
+	'.opus':	{ 'opusenc': () },
+	'.ogg':		{ 'oggenc': () },
+	'.wav':		{},
+	'.wv':		{ 'wavpack': () }
+}
+"""Quality options passed to the encoders of each format"""
+
+FFMPEG_OPTIONS = {
+	'.m4a':		{ 'libfdk_aac': ( '-vbr', '4' ), 'aac': ( '-q:a', '1.0' ) },
+	'.flac':	{ 'flac': ( '-compression_level', '8' ) },
+	'.mp3':		{ 'libmp3lame': ( '-q:a', '0' ) },
+	'.opus':	{ 'libopus': () },
+	'.ogg':		{ 'libvorbis': ( '-q:a', '3' ) },
+	'.wav':		{ 'pcm_s16le': () },
+	'.wv':		{ 'wavpack': () }
+}
+"""Quality options passed to the ffmpeg encoders of each format, in order of preference"""
+
+FFMPEG_COVER_FORMATS = ( '.flac', '.m4a', '.mp3' )
+"""Formats ffmpeg embeds a front cover in as an attached picture"""
+
+WAV_PCM_CODECS = {
+	8:	'pcm_u8',
+	16:	'pcm_s16le',
+	24:	'pcm_s24le',
+	32:	'pcm_s32le'
+}
+"""ffmpeg codecs that write WAV at each number of bits per sample"""
+
+FORMAT_BYTE_RATES = {
+	'.m4a':		20000,
+	'.flac':	100000,
+	'.mp3':		30000,
+	'.opus':	16000,
+	'.ogg':		20000,
+	'.wav':		176400,
+	'.wv':		100000
+}
+"""Typical bytes per second of audio in each format, for estimating durations"""
+
+RETAG_FORMATS = ( '.flac', '.m4a', '.mp3', '.ogg' )
+"""Formats whose tag can be rewritten, so that transcoding to the same format only needs a copy or retag"""
+
+PIPELINE_WINDOW = 1024
+"""Maximum number of transcode jobs planned ahead of the encoders (longest first within it)"""
+
+MANIFEST_FILENAME = '.' + PROGRAM_NAME + '-manifest.json'
+"""Default name of the incremental transcode manifest in the output root"""
+
+MP4_TEXT_ATOMS = {
+	b'\xa9nam':	'title',
+	b'\xa9ART':	'artist',
+	b'\xa9alb':	'album',
+	b'\xa9gen':	'genre',
+	b'\xa9cmt':	'comment'
+}
+"""Map of MP4 ilst text atoms to tag fields"""
+
+VORBIS_COMMENT_FIELDS = {
+	'TITLE':		'title',
+	'ARTIST':		'artist',
+	'ALBUM':		'album',
+	'TRACKNUMBER':	'track',
+	'DISCNUMBER':	'disc',
+	'GENRE':		'genre',
+	'DATE':			'year',
+	'COMMENT':		'comment'
+}
+"""Map of Vorbis comment field names to tag fields"""
+
+LEADING_INT_RE = re.compile( r'\s*(\d+)' )
+"""Leading number of a textual field (e.g. 3/12 or 1999-01-01)"""
+
+APEV2_FIELDS = {
+	'TITLE':	'title',
+	'ARTIST':	'artist',
+	'ALBUM':	'album',
+	'TRACK':	'track',
+	'DISC':		'disc',
+	'GENRE':	'genre',
+	'YEAR':		'year',
+	'COMMENT':	'comment'
+}
+"""Map of APEv2 item keys to tag fields"""
 
 
 #
@@ -173,6 +264,21 @@ ID3V2_TEXT_ENCODING = { 0: 'latin_1', 1: 'utf_16', 2: 'utf_16_be', 3: 'utf_8' }
 """ID3v2 text encoding lookup table"""
 ID3V2_TEXT_TERMS = { 0: b'\x00', 1: b'\x00\x00', 2: b'\x00\x00', 3: b'\x00' }
 """ID3v2 string terminating byte(s) table"""
+ID3V2_PADDING = 4096
+"""Default padding reserved in rewritten ID3v2 tags for later in-place edits"""
+ID3V2_WRITE_FRAMES = (
+	( 'title',		b'TIT2',	3 ),
+	( 'artist',		b'TPE1',	3 ),
+	( 'album',		b'TALB',	3 ),
+	( 'track',		b'TRCK',	0 ),
+	( 'disc',		b'TPOS',	0 ),
+	( 'genre',		b'TCON',	3 ),
+	( 'year',		b'TYER',	0 ),
+	( 'comment',	b'COMM',	3 )
+)
+"""Fields written to ID3v2 tags with their frame IDs and text encodings"""
+ID3V2_TEXT_FRAME_CACHE_SIZE = 1024
+"""Number of encoded text frames kept for reuse across a batch"""
 
 
 #
@@ -180,6 +286,10 @@ ID3V2_TEXT_TERMS = { 0: b'\x00', 1: b'\x00\x00', 2: b'\x00\x00', 3: b'\x00' }
 #
 
 
+class SyncError( Exception ):
+	"""Malformed SynchSafe integer in an ID3v2 tag"""
+
+
 def decode_synchsafe_int( i ):
 	"""Decode SynchSafe integers from ID3v2 tags"""
 	i = int.from_bytes( i, 'big' )
@@ -243,78 +353,199 @@ def read_id3v1( data ):
 	return fields
 
 
+def find_id3v2_term( frame, encoding, pos ):
+	"""Return the offset of the string terminator at or after pos in a frame"""
+	if len( ID3V2_TEXT_TERMS[encoding] ) == 1:
+		while pos < len( frame ) and frame[pos] != 0:
+			pos += 1
+	else:
+		while pos + 1 < len( frame ) and ( frame[pos] != 0 or frame[pos+1] != 0 ):
+			pos += 2
+	return pos
+
+
+def decode_id3v2_string( frame, encoding, start, end=None ):
+	"""Decode the first (possibly terminated) string in a slice of a frame"""
+	return str( frame[start:end], ID3V2_TEXT_ENCODING[encoding] ).split( '\x00' )[0]
+
+
+def read_id3v2_text_frame( name ):
+	"""Make a handler storing a text frame in a field"""
+	def handler( fields, frame ):
+		value = decode_id3v2_string( frame, frame[0], 1 )
+		if len( value ) > 0:
+			fields[name] = value
+	return handler
+
+
+def read_id3v2_number_frame( name ):
+	"""Make a handler storing the leading number of a text frame in a field"""
+	def handler( fields, frame ):
+		mat = LEADING_INT_RE.match( decode_id3v2_string( frame, frame[0], 1 ) )
+		if mat:
+			fields[name] = int( mat.group( 1 ) )
+	return handler
+
+
+def read_id3v2_genre_frame( fields, frame ):
+	"""Store a TCON/TCO frame, resolving ID3v1 genre references"""
+	genre = decode_id3v2_string( frame, frame[0], 1 )
+	mat = re.match( r'\((\d+)\)(.*)', genre ) or re.match( r'(\d+)()$', genre )
+	if mat and int( mat.group( 1 ) ) < 256:
+		genre = mat.group( 2 ) if len( mat.group( 2 ) ) > 0 else ID3V1_GENRES[int( mat.group( 1 ) )]
+	if len( genre ) > 0:
+		fields['genre'] = genre
+
+
+def read_id3v2_comment_frame( fields, frame ):
+	"""Store a COMM/COM frame, preferring the one without a description"""
+	term = find_id3v2_term( frame, frame[0], 4 )
+	if term == 4 or 'comment' not in fields:
+		fields['comment'] = decode_id3v2_string( frame, frame[0], term + len( ID3V2_TEXT_TERMS[frame[0]] ) )
+
+
+def read_id3v2_user_text_frame( fields, frame ):
+	"""Store a TXXX/TXX frame by its description"""
+	term = find_id3v2_term( frame, frame[0], 1 )
+	description = decode_id3v2_string( frame, frame[0], 1, term )
+	fields.setdefault( 'user_text', dict() )[description] = decode_id3v2_string( frame, frame[0], term + len( ID3V2_TEXT_TERMS[frame[0]] ) )
+
+
+def read_id3v2_picture_frame( fields, frame ):
+	"""Store an APIC frame, keeping the front cover (or else the first picture) as the cover"""
+	mime_end = find_id3v2_term( frame, 0, 1 )
+	mime = str( frame[1:mime_end], 'latin_1' )
+	read_id3v2_picture( fields, frame, mime, frame[mime_end+1], mime_end + 2 )
+
+
+def read_id3v2_v22_picture_frame( fields, frame ):
+	"""Store an ID3v2.2 PIC frame"""
+	image_format = str( frame[1:4], 'latin_1' ).lower()
+	read_id3v2_picture( fields, frame, 'image/' + ( 'jpeg' if image_format == 'jpg' else image_format ), frame[4], 5 )
+
+
+def read_id3v2_picture( fields, frame, mime, picture_type, pos ):
+	"""Store a picture given the offset of its description"""
+	term = find_id3v2_term( frame, frame[0], pos )
+	description = decode_id3v2_string( frame, frame[0], pos, term )
+	picture = bytes( frame[term+len( ID3V2_TEXT_TERMS[frame[0]] ):] )
+	fields.setdefault( 'pictures', list() ).append( ( picture_type, mime, description, picture ) )
+	if picture_type == 3 or 'cover' not in fields:
+		fields['cover'] = picture
+
+
+ID3V2_FRAME_HANDLERS = {
+	b'TIT2':	read_id3v2_text_frame( 'title' ),
+	b'TPE1':	read_id3v2_text_frame( 'artist' ),
+	b'TALB':	read_id3v2_text_frame( 'album' ),
+	b'TRCK':	read_id3v2_number_frame( 'track' ),
+	b'TPOS':	read_id3v2_number_frame( 'disc' ),
+	b'TCON':	read_id3v2_genre_frame,
+	b'TYER':	read_id3v2_number_frame( 'year' ),
+	b'TDRL':	read_id3v2_number_frame( 'year' ),
+	b'TDRC':	read_id3v2_number_frame( 'year' ),
+	b'COMM':	read_id3v2_comment_frame,
+	b'TXXX':	read_id3v2_user_text_frame,
+	b'APIC':	read_id3v2_picture_frame,
+	b'TDTG':	read_id3v2_text_frame( 'timestamp' ),
+	b'TT2':		read_id3v2_text_frame( 'title' ),
+	b'TP1':		read_id3v2_text_frame( 'artist' ),
+	b'TAL':		read_id3v2_text_frame( 'album' ),
+	b'TRK':		read_id3v2_number_frame( 'track' ),
+	b'TPA':		read_id3v2_number_frame( 'disc' ),
+	b'TCO':		read_id3v2_genre_frame,
+	b'TYE':		read_id3v2_number_frame( 'year' ),
+	b'COM':		read_id3v2_comment_frame,
+	b'TXX':		read_id3v2_user_text_frame,
+	b'PIC':		read_id3v2_v22_picture_frame
+}
+"""ID3v2 frame handlers by frame ID"""
+
+
+def is_id3v2_frame_start( data, pos, size ):
+	"""Check whether a frame (or the padding) could start at pos"""
+	if pos + 10 > size:
+		return pos == size
+	if data[pos] == 0:
+		return len( bytes( data[pos:size] ).strip( b'\x00' ) ) == 0
+	return bytes( data[pos:pos+4] ).isalnum()
+
+
+def read_id3v2_frame_size( data, pos, size ):
+	"""Read an ID3v2.4 frame size, tolerating writers that store a plain integer"""
+	plain = int.from_bytes( data[pos+4:pos+8], 'big' )
+	if plain & 0x80808080:
+		return plain
+	synchsafe = decode_synchsafe_int( data[pos+4:pos+8] )
+	if synchsafe != plain and not is_id3v2_frame_start( data, pos + 10 + synchsafe, size ) and is_id3v2_frame_start( data, pos + 10 + plain, size ):
+		return plain
+	return synchsafe
+
+
 def read_id3v2_data( data ):
-	"""Read ID3v1 tag assuming it is present and return the fields"""
+	"""Read ID3v2 tag assuming it is present and return the fields"""
 	assert len( data ) >= 10
 	assert data[0:3] == b'ID3'
 	assert data[3] == 2 or data[3] == 3 or data[3] == 4
 	assert data[4] == 0
 
 	fields = dict()
-
-	if data[3] == 2:
-		size = decode_synchsafe_int( data[6:10] ) + 10
+	version = data[3]
+	flags = data[5]
+	size = min( decode_synchsafe_int( data[6:10] ) + 10, len( data ) )
+	view = memoryview( data )
+
+	# Whole tag unsynchronisation (ID3v2.4 does this per frame instead)
+	if version < 4 and flags & 0x80:
+		view = memoryview( bytes( view[:size] ).replace( b'\xff\x00', b'\xff' ) )
+		size = len( view )
+
+	if version == 2:
+		id_size, header_size = 3, 6
 		pos = 10
-
-		while pos + 6 < size and data[pos] != 0:
-			frame_size = int.from_bytes( data[pos+3:pos+6], 'big' )
-
-			if data[pos:pos+3] == b'TT2':
-				fields['title'] = data[pos+7:pos+6+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] )
-			elif data[pos:pos+3] == b'TP1':
-				fields['artist'] = data[pos+7:pos+6+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] )
-			elif data[pos:pos+3] == b'TAL':
-				fields['album'] = data[pos+7:pos+6+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] )
-			elif data[pos:pos+3] == b'TRK':
-				fields['track'] = int( data[pos+7:pos+6+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] ) )
-			elif data[pos:pos+3] == b'TPA':
-				fields['disc'] = int( data[pos+7:pos+6+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] ) )
-			elif data[pos:pos+3] == b'TCO':
-				fields['genre'] = data[pos+7:pos+6+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] )
-			elif data[pos:pos+3] == b'TYE':
-				fields['year'] = int( data[pos+7:pos+6+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] ) )
-			elif data[pos:pos+3] == b'COM':
-				fields['comment'] = data[data.find( ID3V2_TEXT_TERMS[data[pos+6]], pos+10 ) + 1 : pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+6]] )
-			elif data[pos:pos+3] == b'PIC':
-				fields['cover'] = data[data.find( ID3V2_TEXT_TERMS[data[pos+6]], pos+11 ) + 1 : pos+10+frame_size]
-
-			pos += frame_size + 6
-
-	elif data[3] == 3 or data[3] == 4:
-		size = decode_synchsafe_int( data[6:10] ) + 10
-		if data[5] & 0x40:
-			pos = 10 + decode_synchsafe_int( data[10:14] )
+	else:
+		id_size, header_size = 4, 10
+		if flags & 0x40:
+			pos = 14 + int.from_bytes( view[10:14], 'big' ) if version == 3 else 10 + decode_synchsafe_int( view[10:14] )
 		else:
 			pos = 10
 
-		while pos + 10 <= size and data[pos] != 0:
-			frame_size = int.from_bytes( data[pos+4:pos+8], 'big' )
-
-			if data[pos:pos+4] == b'TIT2':
-				fields['title'] = data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] )
-			elif data[pos:pos+4] == b'TPE1':
-				fields['artist'] = data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] )
-			elif data[pos:pos+4] == b'TALB':
-				fields['album'] = data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] )
-			elif data[pos:pos+4] == b'TRCK':
-				fields['track'] = int( data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] ) )
-			elif data[pos:pos+4] == b'TPOS':
-				fields['disc'] = int( data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] ) )
-			elif data[pos:pos+4] == b'TCON':
-				fields['genre'] = data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] )
-				mat = re.match( '\((\d+)\)(\w+)', fields['genre'] )
-				if mat and int( mat.group( 1 ) ) < 256 and ID3V1_GENRES[int( mat.group( 1 ) )] == mat.group( 2 ):
-					fields['genre'] = mat.group( 2 )
-			elif data[pos:pos+4] == b'TYER' or data[pos:pos+4] == b'TDRL' or data[pos:pos+4] == b'TDRC':
-				fields['year'] = int( data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] ) )
-			elif data[pos:pos+4] == b'COMM':
-				fields['comment'] = data[data.find( ID3V2_TEXT_TERMS[data[pos+10]], pos+14 ) + len( ID3V2_TEXT_TERMS[data[pos+10]] ) : pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] )
-			elif data[pos:pos+4] == b'APIC':
-				fields['cover'] = data[data.find( ID3V2_TEXT_TERMS[data[pos+10]], data.find( b'\x00', pos+11 ) + 2 ) + len( ID3V2_TEXT_TERMS[data[pos+10]] ) : pos+10+frame_size]
-			elif data[pos:pos+4] == b'TDTG':
-				fields['timestamp'] = data[pos+11:pos+10+frame_size].decode( ID3V2_TEXT_ENCODING[data[pos+10]] )
-
-			pos += 10 + frame_size
+	while pos + header_size <= size and view[pos] != 0:
+		if version == 2:
+			frame_size = int.from_bytes( view[pos+3:pos+6], 'big' )
+			frame_flags = 0
+		elif version == 3:
+			frame_size = int.from_bytes( view[pos+4:pos+8], 'big' )
+			frame_flags = view[pos+9]
+		else:
+			frame_size = read_id3v2_frame_size( view, pos, size )
+			frame_flags = view[pos+9]
+		handler = ID3V2_FRAME_HANDLERS.get( bytes( view[pos:pos+id_size] ) )
+		frame = view[pos+header_size:pos+header_size+frame_size]
+		pos += header_size + frame_size
+		if handler is None:
+			continue
+
+		try:
+			# Per frame format flags
+			if version == 3:
+				if frame_flags & 0x40:
+					continue	# encrypted
+				frame = frame[( 4 if frame_flags & 0x80 else 0 ) + ( 1 if frame_flags & 0x20 else 0 ):]
+				if frame_flags & 0x80:
+					frame = memoryview( zlib.decompress( frame ) )
+			elif version == 4:
+				if frame_flags & 0x04:
+					continue	# encrypted
+				frame = frame[( 1 if frame_flags & 0x40 else 0 ) + ( 4 if frame_flags & 0x01 else 0 ):]
+				if frame_flags & 0x02 or flags & 0x80:
+					frame = memoryview( bytes( frame ).replace( b'\xff\x00', b'\xff' ) )
+				if frame_flags & 0x08:
+					frame = memoryview( zlib.decompress( frame ) )
+			if len( frame ) > 1:
+				handler( fields, frame )
+		except ( ValueError, LookupError, zlib.error ):
+			pass	# skip malformed frames
 
 	return fields
 
@@ -332,101 +563,143 @@ def read_id3v2_header( data ):
 	return dict()
 
 
+def find_id3v2_footer( data ):
+	"""Return the offset of an appended ID3v2 tag, or -1 if there is none"""
+	# A SEEK frame in the header tag points straight at the appended tag
+	size = id3v2_header_size( data )
+	if size > 0 and data[3] == 4:
+		pos = 10 + decode_synchsafe_int( data[10:14] ) if data[5] & 0x40 else 10
+		while pos + 10 <= size and data[pos] != 0:
+			if data[pos:pos+4] == b'SEEK':
+				pos = size + int.from_bytes( data[pos+10:pos+14], 'big' )
+				if data[pos:pos+3] == b'ID3':
+					return pos
+				break
+			pos += 10 + read_id3v2_frame_size( data, pos, size )
+
+	# Otherwise look for a footer at the end of the file, before any ID3v1 and APEv2 tags
+	end = len( data ) - id3v1_size( data )
+	ends = [ end ]
+	if end >= 32 and data[end-32:end-24] == b'APETAGEX':
+		ends.append( end - int.from_bytes( data[end-20:end-16], 'little' ) - ( 32 if data[end-9] & 0x80 else 0 ) )
+	for end in ends:
+		if end >= 10 and data[end-10:end-7] == b'3DI' and data[end-7] == 4 and data[end-6] == 0:
+			pos = end - 20 - decode_synchsafe_int( data[end-4:end] )
+			if pos >= 0 and data[pos:pos+3] == b'ID3':
+				return pos
+	return -1
+
+
 def read_id3v2_footer( data ):
 	"""Read IDv3 footer if present and return the fields"""
-	pos = len( data ) - 10
-	while pos > 0:
-		if data[pos:pos+3] == b'ID3' and data[pos+4] == 0:
-			if data[pos+3] == 2 or data[pos+3] == 3:
-				return read_id3v2_data( data[pos:pos+10+decode_synchsafe_int( data[6:10] )] )
-			elif data[pos+3] == 4:
-				if data[5] & 0x10:
-					return read_id3v2_data( data[pos:pos+20+decode_synchsafe_int( data[6:10] )] )
-				else:
-					return read_id3v2_data( data[pos:pos+10+decode_synchsafe_int( data[6:10] )] )
-		pos -= 1
-	return dict()
+	pos = find_id3v2_footer( data )
+	if pos == -1:
+		return dict()
+	return read_id3v2_data( data[pos:pos+id3v2_header_size( data[pos:pos+10] )] )
+
+
+def mp3_audio_ranges( data ):
+	"""Return the ( offset, count ) ranges of MP3 data left once its ID3v2 header, appended ID3v2 and ID3v1 tags are dropped"""
+	start = id3v2_header_size( data )
+	end = len( data ) - id3v1_size( data )
+	pos = find_id3v2_footer( data )
+	if pos == -1:
+		ranges = ( ( start, end - start ), )
+	else:
+		tag_end = min( pos + id3v2_header_size( data[pos:pos+10] ), end )
+		ranges = ( ( start, pos - start ), ( tag_end, end - tag_end ) )
+	return [ ( offset, count ) for offset, count in ranges if count > 0 ]
 
 
-def remove_id3v1( data ):
-	"""Remove ID3v1 tag if present"""
-	if len( data ) >= 355:
-		if data[-128:-125] == b'TAG':
-			if data[-355:351] == b'TAG+':
-				return data[0:-355]
-			else:
-				return data[0:-128]
-	elif len( data ) >= 128:
-		if data[-128:-125] == b'TAG':
-			return data[0:-128]
-	return data
+def id3v1_size( data ):
+	"""Return the size of the ID3v1 tag (including any TAG+ block) if present"""
+	if len( data ) >= 128 and data[-128:-125] == b'TAG':
+		if len( data ) >= 355 and data[-355:-351] == b'TAG+':
+			return 355
+		return 128
+	return 0
 
 
-def remove_id3v2_header( data ):
-	"""Remove ID3v2 header tag if present"""
+def id3v2_header_size( data ):
+	"""Return the size of the ID3v2 header tag (including any footer) if present"""
 	if len( data ) >= 10 and data[0:3] == b'ID3' and data[4] == 0:
 		if data[3] == 2 or data[3] == 3:
-			return data[decode_synchsafe_int( data[6:10] )+10:]
+			return decode_synchsafe_int( data[6:10] ) + 10
 		elif data[3] == 4:
 			if data[5] & 0x10:
-				return data[decode_synchsafe_int( data[6:10] )+20:]
+				return decode_synchsafe_int( data[6:10] ) + 20
 			else:
-				return data[decode_synchsafe_int( data[6:10] )+10:]
-	return data
+				return decode_synchsafe_int( data[6:10] ) + 10
+	return 0
+
+
+def remove_id3v1( data ):
+	"""Remove ID3v1 tag if present"""
+	return data[0:len( data )-id3v1_size( data )]
+
+
+def remove_id3v2_header( data ):
+	"""Remove ID3v2 header tag if present"""
+	return data[id3v2_header_size( data ):]
 
 
 def remove_id3v2_footer( data ):
 	"""Remove ID3v2 footer tag if present"""
-	pos = len( data ) - 10
-	while pos > 0:
-		if data[pos:pos+3] == b'ID3' and data[pos+4] == 0:
-			if data[pos+3] == 2 or data[pos+3] == 3:
-				return data[:pos] + data[pos+decode_synchsafe_int( data[6:10] )+10:]
-			elif data[pos+3] == 4:
-				if data[pos+5] & 0x10:
-					return data[:pos] + data[pos+decode_synchsafe_int( data[6:10] )+20:]
-				else:
-					return data[:pos] + data[pos+decode_synchsafe_int( data[6:10] )+10:]
-		pos -= 1
-	return data
+	pos = find_id3v2_footer( data )
+	if pos == -1:
+		return data
+	return data[:pos] + data[pos+id3v2_header_size( data[pos:pos+10] ):]
 
 
-def write_id3v2_header( data, fields ):
-	"""Add an ID3v2 header to the data assuming none already present"""
-	body = bytes()
-
-	if 'title' in fields:
-		title_bytes = b'\x03' + fields['title'].encode( 'utf_8' )
-		body += b'TIT2' + len( title_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + title_bytes
-	if 'artist' in fields:
-		artist_bytes = b'\x03' + fields['artist'].encode( 'utf_8' )
-		body += b'TPE1' + len( artist_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + artist_bytes
-	if 'album' in fields:
-		album_bytes = b'\x03' + fields['album'].encode( 'utf_8' )
-		body += b'TALB' + len( album_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + album_bytes
-	if 'track' in fields:
-		track_bytes = b'\x00' + str( fields['track'] ).encode( 'latin_1' )
-		body += b'TRCK' + len( track_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + track_bytes
-	if 'disc' in fields:
-		disc_bytes = b'\x00' + str( fields['disc'] ).encode( 'latin_1' )
-		body += b'TPOS' + len( disc_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + disc_bytes
-	if 'genre' in fields:
-		genre_bytes = b'\x03' + fields['genre'].encode( 'utf_8' )
-		body += b'TCON' + len( genre_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + genre_bytes
-	if 'year' in fields:
-		year_bytes = b'\x00' + str( fields['year'] ).encode( 'latin_1' )
-		body += b'TYER' + len( year_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + year_bytes
-	if 'comment' in fields:
-		comment_bytes = b'\x03   \x00' + fields['comment'].encode( 'utf_8' )
-		body += b'COMM' + len( comment_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + comment_bytes
+@functools.lru_cache( maxsize=ID3V2_TEXT_FRAME_CACHE_SIZE )
+def encode_id3v2_text_frame( frame_id, encoding, value ):
+	"""Encode an ID3v2.4 text frame"""
+	payload = str( value ).encode( ID3V2_TEXT_ENCODING[encoding] )
+	if frame_id == b'COMM':
+		# Language and empty description
+		return b''.join( ( frame_id, encode_synchsafe_int( len( payload ) + 5 ), b'\x00\x00', bytes( ( encoding, ) ), b'   \x00', payload ) )
+	return b''.join( ( frame_id, encode_synchsafe_int( len( payload ) + 1 ), b'\x00\x00', bytes( ( encoding, ) ), payload ) )
+
+
+def encode_id3v2_picture_frame( picture ):
+	"""Encode a front cover as an ID3v2.4 APIC frame"""
+	head = b'\x00' + probe_image( picture )[0].encode( 'latin_1' ) + b'\x00\x03\x00'
+	return b''.join( ( b'APIC', encode_synchsafe_int( len( head ) + len( picture ) ), b'\x00\x00', head, picture ) )
+
+
+def write_id3v2_frames( fields ):
+	"""Encode the fields as a list of ID3v2.4 frames"""
+	frames = list()
+
+	for name, frame_id, encoding in ID3V2_WRITE_FRAMES:
+		if name in fields:
+			frames.append( encode_id3v2_text_frame( frame_id, encoding, fields[name] ) )
 	if 'cover' in fields:
-		cover_bytes = b'\x00' + ( 'image/' + imghdr.what( '', h=fields['cover'] ) ).encode( 'latin_1' ) + b'\x00\x03\x00' + fields['cover']
-		body += b'APIC' + len( cover_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + cover_bytes
+		if isinstance( fields['cover'], str ):
+			frames.append( load_cover( fields['cover'], 'apic' ) )
+		else:
+			frames.append( encode_id3v2_picture_frame( fields['cover'] ) )
 	fields['timestamp'] = datetime.datetime.utcnow().replace( microsecond=0 ).isoformat()
-	timestamp_bytes = b'\x00' + fields['timestamp'].encode( 'latin_1' )
-	body += b'TDTG' + len( timestamp_bytes ).to_bytes( 4, 'big' ) + b'\x00\x00' + timestamp_bytes
+	frames.append( encode_id3v2_text_frame( b'TDTG', 0, fields['timestamp'] ) )
 
-	return b'ID3\x04\x00\x00' + encode_synchsafe_int( len( body ) ) + body + data
+	return frames
+
+
+def write_id3v2_tag( frames, padding=0 ):
+	"""Assemble encoded frames into an ID3v2.4 tag with padding"""
+	return b''.join( [ b'ID3\x04\x00\x00' + encode_synchsafe_int( sum( map( len, frames ) ) + padding ) ] + frames + [ bytes( padding ) ] )
+
+
+def write_id3v2_file( out_file, frames, padding=0 ):
+	"""Write encoded frames as an ID3v2.4 tag with padding to a file without assembling it"""
+	out_file.write( b'ID3\x04\x00\x00' + encode_synchsafe_int( sum( map( len, frames ) ) + padding ) )
+	out_file.writelines( frames )
+	out_file.write( bytes( padding ) )
+
+
+def write_id3v2_header( data, fields, padding=0 ):
+	"""Add an ID3v2 header to the data assuming none already present"""
+	return write_id3v2_tag( write_id3v2_frames( fields ), padding ) + data
 
 
 #
@@ -442,55 +715,496 @@ def read_metadatablockpicture( data ):
 	return data[4+off:4+off+size]
 
 
-def write_metadatablockpicture( picture_path ):
-	"""Create a METADATA_BLOCK_PICTURE from a picture"""
-	# Probe
-	probe_out = subprocess.check_output( ( 'identify', '-verbose', picture_path ), stderr=subprocess.DEVNULL ).decode( errors='ignore' )
-	# Picture type
-	mbp = b'\x00\x00\x00\x03'
-	# Picture MIME
-	if probe_out.find( '  Format: JPEG' ) != -1:
-		mbp += b'\x00\x00\x00\x0Aimage/jpeg'
-	elif probe_out.find( '  Format: PNG' ) != -1:
-		mbp += b'\x00\x00\x00\x09image/png'
-	elif probe_out.find( '  Format: GIF' ) != -1:
-		mbp += b'\x00\x00\x00\x09image/gif'
-	else:
-		mbp += b'\x00\x00\x00\x06image/'
-	# Picture description
-	mbp += b'\x00\x00\x00\x00'
-	# Picture dimensions
-	dim_mat = re.search( r'^  Geometry: (\d+)x(\d+)', probe_out, re.M )
-	mbp += int( dim_mat.group( 1 ) ).to_bytes( 4, 'big' )
-	mbp += int( dim_mat.group( 2 ) ).to_bytes( 4, 'big' )
-	# Picture bits-per-pixel
-	depth = 0
-	mat = re.search( r'^    red: (\d+)-bit$', probe_out, re.M )
-	if mat:
-		depth += int( mat.group( 1 ) )
-	mat = re.search( r'^    green: (\d+)-bit$', probe_out, re.M )
-	if mat:
-		depth += int( mat.group( 1 ) )
-	mat = re.search( r'^    blue: (\d+)-bit$', probe_out, re.M )
-	if mat:
-		depth += int( mat.group( 1 ) )
-	mat = re.search( r'^    alpha: (\d+)-bit$', probe_out, re.M )
-	if mat:
-		depth += int( mat.group( 1 ) )
-	mbp += depth.to_bytes( 4, 'big' )
-	# Number of colors (indexed pictures)
-	mat = re.search( r'^  Colors: (\d+)$', probe_out, re.M )
-	if mat:
-		mbp += int( mat.group( 1 ) ).to_bytes( 4, 'big' )
+def probe_image( data ):
+	"""Return the MIME type, width, height, bits per pixel and palette size of a JPEG, PNG or GIF"""
+	if data[0:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+		width = int.from_bytes( data[16:20], 'big' )
+		height = int.from_bytes( data[20:24], 'big' )
+		bit_depth = data[24]
+		color_type = data[25]
+		if color_type == 3:
+			# Indexed; palette entries are always 8-bit RGB
+			colors = 0
+			pos = 33
+			while pos + 8 <= len( data ):
+				chunk_size = int.from_bytes( data[pos:pos+4], 'big' )
+				if data[pos+4:pos+8] == b'PLTE':
+					colors = chunk_size // 3
+					break
+				if data[pos+4:pos+8] == b'IDAT':
+					break
+				pos += 12 + chunk_size
+			return 'image/png', width, height, 24, colors
+		return 'image/png', width, height, bit_depth * { 0: 1, 2: 3, 4: 2, 6: 4 }.get( color_type, 1 ), 0
+	elif data[0:2] == b'\xff\xd8':
+		pos = 2
+		while pos + 4 <= len( data ):
+			if data[pos] != 0xFF:
+				break
+			marker = data[pos+1]
+			if marker == 0xFF:
+				pos += 1	# fill byte
+				continue
+			if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+				pos += 2	# no payload
+				continue
+			if 0xC0 <= marker <= 0xCF and marker not in ( 0xC4, 0xC8, 0xCC ):
+				# Start of frame: precision, height, width, components
+				return 'image/jpeg', int.from_bytes( data[pos+7:pos+9], 'big' ), int.from_bytes( data[pos+5:pos+7], 'big' ), data[pos+4] * data[pos+9], 0
+			pos += 2 + int.from_bytes( data[pos+2:pos+4], 'big' )
+		return 'image/jpeg', 0, 0, 0, 0
+	elif data[0:6] == b'GIF87a' or data[0:6] == b'GIF89a':
+		# Logical screen descriptor
+		colors = 1 << ( ( data[10] & 0x07 ) + 1 ) if data[10] & 0x80 else 0
+		return 'image/gif', int.from_bytes( data[6:8], 'little' ), int.from_bytes( data[8:10], 'little' ), 24, colors
+	return 'image/', 0, 0, 0, 0
+
+
+def write_metadatablockpicture( picture ):
+	"""Create a front cover METADATA_BLOCK_PICTURE from picture data"""
+	mime, width, height, depth, colors = probe_image( picture )
+	mime = mime.encode( 'ascii' )
+	return b''.join( (
+		# Picture type
+		b'\x00\x00\x00\x03',
+		# Picture MIME
+		len( mime ).to_bytes( 4, 'big' ), mime,
+		# Picture description
+		b'\x00\x00\x00\x00',
+		# Picture dimensions
+		width.to_bytes( 4, 'big' ), height.to_bytes( 4, 'big' ),
+		# Picture bits-per-pixel
+		depth.to_bytes( 4, 'big' ),
+		# Number of colors (indexed pictures)
+		colors.to_bytes( 4, 'big' ),
+		# Picture data
+		len( picture ).to_bytes( 4, 'big' ), picture
+	) )
+
+
+#
+# Cover art functions
+#
+
+
+def store_cover( picture ):
+	"""Store a cover once per run under its content hash and return its path"""
+	with trace_stage( 'cover' ):
+		digest = hashlib.sha1( picture ).hexdigest()
+		path = os.path.join( tmpdir.name, 'cover-' + digest + '.' + ( probe_image( picture )[0][6:] or 'img' ) )
+		with cover_cache_lock:
+			if path not in cover_digests:
+				with open( path, 'wb' ) as cover_file:
+					cover_file.write( picture )
+				cover_digests[path] = digest
+	return path
+
+
+def cover_digest( path ):
+	"""Return the content hash of a cover file"""
+	with cover_cache_lock:
+		if path in cover_digests:
+			return cover_digests[path]
+	with open( path, 'rb' ) as cover_file:
+		digest = hashlib.sha1( cover_file.read() ).hexdigest()
+	with cover_cache_lock:
+		cover_digests[path] = digest
+	return digest
+
+
+def load_cover( path, form='raw' ):
+	"""Return a cover as raw bytes or as 'mbp', 'mbp_base64' or 'apic', memoized by content"""
+	global cover_cache_size
+
+	key = ( cover_digest( path ), form )
+	with cover_cache_lock:
+		if key in cover_cache:
+			cover_cache.move_to_end( key )
+			return cover_cache[key]
+
+	with trace_stage( 'cover', path ):
+		if form == 'raw':
+			with open( path, 'rb' ) as cover_file:
+				value = cover_file.read()
+		elif form == 'mbp':
+			value = write_metadatablockpicture( load_cover( path ) )
+		elif form == 'mbp_base64':
+			value = base64.b64encode( load_cover( path, 'mbp' ) )
+		elif form == 'apic':
+			value = encode_id3v2_picture_frame( load_cover( path ) )
+		else:
+			raise Exception( 'Unknown cover form ' + form + '!' )
+
+	with cover_cache_lock:
+		if key not in cover_cache:
+			cover_cache[key] = value
+			cover_cache_size += len( value )
+			# Evict least recently used forms, but never the one just added
+			while cover_cache_size > COVER_CACHE_BUDGET and len( cover_cache ) > 1:
+				cover_cache_size -= len( cover_cache.popitem( last=False )[1] )
+	return value
+
+
+#
+# Vorbis comment and FLAC functions
+#
+
+
+def read_vorbis_comment( data ):
+	"""Read a Vorbis comment packet (without framing) and return the fields"""
+	fields = dict()
+
+	pos = 4 + int.from_bytes( data[0:4], 'little' )
+	count = int.from_bytes( data[pos:pos+4], 'little' )
+	pos += 4
+	for i in range( count ):
+		if pos + 4 > len( data ):
+			break
+		length = int.from_bytes( data[pos:pos+4], 'little' )
+		name, sep, value = data[pos+4:pos+4+length].decode( 'utf_8', errors='replace' ).partition( '=' )
+		pos += 4 + length
+		name = name.upper()
+		if name in VORBIS_COMMENT_FIELDS:
+			key = VORBIS_COMMENT_FIELDS[name]
+			if key in ( 'track', 'disc', 'year' ):
+				mat = LEADING_INT_RE.match( value )
+				if mat:
+					fields[key] = int( mat.group( 1 ) )
+			elif len( value ) > 0:
+				fields[key] = value
+		elif name == 'METADATA_BLOCK_PICTURE':
+			try:
+				picture = base64.b64decode( value )
+			except binascii.Error:
+				continue	# skip malformed pictures
+			if 'cover' not in fields or int.from_bytes( picture[0:4], 'big' ) == 3:
+				fields['cover'] = read_metadatablockpicture( picture )
+
+	return fields
+
+
+def read_flac_metadata( path ):
+	"""Read the VORBIS_COMMENT and front cover PICTURE blocks of a FLAC file"""
+	fields = dict()
+
+	with open( path, 'rb' ) as flac_file:
+		header = flac_file.read( 10 )
+		# Skip over a (non-standard) leading ID3v2 tag
+		if len( header ) == 10 and header[0:3] == b'ID3':
+			flac_file.seek( 10 + decode_synchsafe_int( header[6:10] ) + ( 10 if header[5] & 0x10 else 0 ) )
+		else:
+			flac_file.seek( 0 )
+		if flac_file.read( 4 ) != b'fLaC':
+			raise Exception( 'Not a valid FLAC file: ' + path )
+
+		last = False
+		while not last:
+			header = flac_file.read( 4 )
+			if len( header ) < 4:
+				break
+			last = header[0] & 0x80
+			block_type = header[0] & 0x7F
+			block_size = int.from_bytes( header[1:4], 'big' )
+			if block_type == 4:
+				fields.update( read_vorbis_comment( flac_file.read( block_size ) ) )
+			elif block_type == 6:
+				block = flac_file.read( block_size )
+				if int.from_bytes( block[0:4], 'big' ) == 3:
+					fields['cover'] = read_metadatablockpicture( block )
+			else:
+				flac_file.seek( block_size, os.SEEK_CUR )
+
+	return fields
+
+
+def write_vorbis_comment( fields, vendor=PROGRAM_NAME.encode( 'ascii' ) ):
+	"""Create a Vorbis comment packet (without framing) from the fields, leaving out the cover"""
+	comments = [ ( name + '=' + str( fields[key] ) ).encode( 'utf_8' ) for name, key in VORBIS_COMMENT_FIELDS.items() if key in fields ]
+	return b''.join( [ len( vendor ).to_bytes( 4, 'little' ), vendor, len( comments ).to_bytes( 4, 'little' ) ] + [ len( c ).to_bytes( 4, 'little' ) + c for c in comments ] )
+
+
+def write_flac_file( in_file, out_file, fields, padding=ID3V2_PADDING ):
+	"""Copy a FLAC file replacing its VORBIS_COMMENT, PICTURE and PADDING blocks with ones for the fields"""
+	header = in_file.read( 10 )
+	# Drop a (non-standard) leading ID3v2 tag
+	if len( header ) == 10 and header[0:3] == b'ID3':
+		in_file.seek( 10 + decode_synchsafe_int( header[6:10] ) + ( 10 if header[5] & 0x10 else 0 ) )
 	else:
-		mbp += b'\x00\x00\x00\x00'
-	# Picture data
-	with open( picture_path, "rb" ) as picture_file:
-		picture = picture_file.read()
-	mbp += len( picture ).to_bytes( 4, 'big' )
-	mbp += picture
-	# Done
-	return mbp
+		in_file.seek( 0 )
+	if in_file.read( 4 ) != b'fLaC':
+		raise Exception( 'Not a valid FLAC file: ' + in_file.name )
+
+	blocks = list()
+	vendor = PROGRAM_NAME.encode( 'ascii' )
+	last = False
+	while not last:
+		header = in_file.read( 4 )
+		if len( header ) < 4:
+			raise Exception( 'Truncated FLAC metadata in ' + in_file.name )
+		last = header[0] & 0x80
+		block_type = header[0] & 0x7F
+		block = in_file.read( int.from_bytes( header[1:4], 'big' ) )
+		if block_type == 4:
+			vendor = block[4:4+int.from_bytes( block[0:4], 'little' )]
+		elif block_type != 1 and block_type != 6:
+			blocks.append( ( block_type, block ) )
+
+	blocks.append( ( 4, write_vorbis_comment( fields, vendor ) ) )
+	if 'cover' in fields:
+		blocks.append( ( 6, load_cover( fields['cover'], 'mbp' ) if isinstance( fields['cover'], str ) else write_metadatablockpicture( fields['cover'] ) ) )
+	blocks.append( ( 1, bytes( padding ) ) )
+
+	audio_start = in_file.tell()
+	out_file.write( b'fLaC' )
+	for i, ( block_type, block ) in enumerate( blocks ):
+		out_file.write( bytes( ( block_type | ( 0x80 if i == len( blocks ) - 1 else 0 ), ) ) + len( block ).to_bytes( 3, 'big' ) )
+		out_file.write( block )
+	copy_file_data( in_file, out_file, audio_start, os.fstat( in_file.fileno() ).st_size - audio_start )
+
+
+#
+# Ogg functions
+#
+
+
+def read_ogg_packets( ogg_file, count ):
+	"""Read the first packets of the first logical stream in an Ogg file"""
+	packets = list()
+	packet = bytearray()
+	serial = None
+
+	while len( packets ) < count:
+		header = ogg_file.read( 27 )
+		if len( header ) < 27 or header[0:4] != b'OggS':
+			break
+		lacing = ogg_file.read( header[26] )
+		page_size = sum( lacing )
+		if serial is None:
+			serial = header[14:18]
+		elif header[14:18] != serial:
+			ogg_file.seek( page_size, os.SEEK_CUR )
+			continue
+		page = ogg_file.read( page_size )
+		pos = 0
+		for lace in lacing:
+			packet += page[pos:pos+lace]
+			pos += lace
+			if lace < 255:
+				packets.append( bytes( packet ) )
+				packet = bytearray()
+				if len( packets ) == count:
+					break
+
+	return packets
+
+
+def read_ogg_metadata( path ):
+	"""Read the comment header of an Ogg Vorbis or Ogg Opus file"""
+	with open( path, 'rb' ) as ogg_file:
+		packets = read_ogg_packets( ogg_file, 2 )
+	if len( packets ) == 2:
+		if packets[1][0:7] == b'\x03vorbis':
+			return read_vorbis_comment( packets[1][7:] )
+		elif packets[1][0:8] == b'OpusTags':
+			return read_vorbis_comment( packets[1][8:] )
+	raise Exception( 'No Vorbis or Opus comment header found in ' + path )
+
+
+#
+# MP4 functions
+#
+
+
+def find_mp4_box( mp4_file, name, end=None ):
+	"""Seek through sibling MP4 boxes and return the payload bounds of the named one"""
+	if end is None:
+		end = mp4_file.seek( 0, os.SEEK_END )
+		mp4_file.seek( 0 )
+	pos = mp4_file.tell()
+	while pos + 8 <= end:
+		mp4_file.seek( pos )
+		header = mp4_file.read( 8 )
+		size = int.from_bytes( header[0:4], 'big' )
+		header_size = 8
+		if size == 1:
+			size = int.from_bytes( mp4_file.read( 8 ), 'big' )
+			header_size = 16
+		elif size == 0:
+			size = end - pos
+		if size < header_size:
+			break
+		if header[4:8] == name:
+			mp4_file.seek( pos + header_size )
+			return pos + header_size, pos + size
+		# Seek past the box (e.g. mdat) without reading it
+		pos += size
+	return None
+
+
+def read_mp4_metadata( path ):
+	"""Read the moov/udta/meta/ilst atoms of an MP4 file and return the fields"""
+	fields = dict()
+
+	with open( path, 'rb' ) as mp4_file:
+		bounds = find_mp4_box( mp4_file, b'moov' )
+		if bounds is not None:
+			bounds = find_mp4_box( mp4_file, b'udta', bounds[1] )
+		if bounds is not None:
+			bounds = find_mp4_box( mp4_file, b'meta', bounds[1] )
+		if bounds is not None:
+			# meta is a full box; skip version and flags
+			mp4_file.seek( 4, os.SEEK_CUR )
+			bounds = find_mp4_box( mp4_file, b'ilst', bounds[1] )
+		if bounds is None:
+			return fields
+		data = mp4_file.read( bounds[1] - bounds[0] )
+
+	pos = 0
+	while pos + 8 <= len( data ):
+		item_size = int.from_bytes( data[pos:pos+4], 'big' )
+		if item_size < 8:
+			break
+		atom = data[pos+4:pos+8]
+		# First data box of the item
+		if data[pos+12:pos+16] == b'data':
+			data_size = int.from_bytes( data[pos+8:pos+12], 'big' )
+			value = data[pos+24:pos+8+data_size]
+			if atom in MP4_TEXT_ATOMS:
+				fields[MP4_TEXT_ATOMS[atom]] = value.decode( 'utf_8', errors='replace' )
+			elif atom == b'\xa9day':
+				mat = LEADING_INT_RE.match( value.decode( 'utf_8', errors='replace' ) )
+				if mat:
+					fields['year'] = int( mat.group( 1 ) )
+			elif atom == b'trkn' and len( value ) >= 4:
+				if int.from_bytes( value[2:4], 'big' ) > 0:
+					fields['track'] = int.from_bytes( value[2:4], 'big' )
+			elif atom == b'disk' and len( value ) >= 4:
+				if int.from_bytes( value[2:4], 'big' ) > 0:
+					fields['disc'] = int.from_bytes( value[2:4], 'big' )
+			elif atom == b'gnre' and 'genre' not in fields and len( value ) >= 2:
+				if 0 < int.from_bytes( value[0:2], 'big' ) <= len( ID3V1_GENRES ):
+					fields['genre'] = ID3V1_GENRES[int.from_bytes( value[0:2], 'big' ) - 1]
+			elif atom == b'covr':
+				fields['cover'] = value
+		pos += item_size
+
+	return fields
+
+
+#
+# APEv2 functions
+#
+
+
+def read_apev2_tag( path ):
+	"""Read an APEv2 tag at the end of a file if present and return the fields"""
+	fields = dict()
+
+	with open( path, 'rb' ) as ape_file:
+		end = ape_file.seek( 0, os.SEEK_END )
+		if end < 32:
+			return fields
+		ape_file.seek( end - 32 )
+		footer = ape_file.read( 32 )
+		# The APEv2 tag may be followed by an ID3v1 tag
+		if footer[0:8] != b'APETAGEX' and end >= 160:
+			ape_file.seek( end - 128 )
+			if ape_file.read( 3 ) == b'TAG':
+				end -= 128
+				ape_file.seek( end - 32 )
+				footer = ape_file.read( 32 )
+		if footer[0:8] != b'APETAGEX':
+			return fields
+		size = int.from_bytes( footer[12:16], 'little' )
+		count = int.from_bytes( footer[16:20], 'little' )
+		if size < 32 or size > end:
+			return fields
+		ape_file.seek( end - size )
+		data = ape_file.read( size - 32 )
+
+	pos = 0
+	for i in range( count ):
+		if pos + 8 > len( data ):
+			break
+		value_size = int.from_bytes( data[pos:pos+4], 'little' )
+		flags = int.from_bytes( data[pos+4:pos+8], 'little' )
+		key_end = data.find( b'\x00', pos + 8 )
+		if key_end == -1:
+			break
+		key = data[pos+8:key_end].decode( 'ascii', errors='replace' ).upper()
+		value = data[key_end+1:key_end+1+value_size]
+		pos = key_end + 1 + value_size
+		if key in APEV2_FIELDS and flags & 0x06 == 0:
+			value = value.decode( 'utf_8', errors='replace' ).split( '\x00' )[0]
+			if APEV2_FIELDS[key] in ( 'track', 'disc', 'year' ):
+				mat = LEADING_INT_RE.match( value )
+				if mat:
+					fields[APEV2_FIELDS[key]] = int( mat.group( 1 ) )
+			elif len( value ) > 0:
+				fields[APEV2_FIELDS[key]] = value
+		elif key == 'COVER ART (FRONT)' and flags & 0x06 == 0x02:
+			# Binary item: file name, NUL, picture data
+			fields['cover'] = value[value.find( b'\x00' ) + 1:]
+
+	return fields
+
+
+#
+# Trace functions
+#
+
+
+def start_trace():
+	"""Start recording trace events"""
+	global trace_events
+	trace_events = list()
+
+
+@contextlib.contextmanager
+def trace_stage( name, path=None ):
+	"""Record the with block as a stage of the current thread"""
+	if trace_events is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		end = time.perf_counter()
+		thread = threading.current_thread()
+		event = { 'name': name, 'cat': 'stage', 'ph': 'X', 'ts': ( start - trace_epoch ) * 1e6, 'dur': ( end - start ) * 1e6, 'pid': os.getpid(), 'tid': thread.ident }
+		if path is not None:
+			event['args'] = { 'file': path }
+		with trace_lock:
+			trace_events.append( event )
+			trace_threads[thread.ident] = thread.name
+
+
+def trace_span( name, category, start, end, path=None ):
+	"""Record an interval that may overlap others, such as a queue wait or a codec process, as an async event"""
+	if trace_events is None:
+		return
+	event = { 'name': name, 'cat': category, 'pid': os.getpid(), 'tid': threading.get_ident() }
+	if path is not None:
+		event['args'] = { 'file': path }
+	with trace_lock:
+		event['id'] = len( trace_events )
+		trace_events.append( dict( event, ph='b', ts=( start - trace_epoch ) * 1e6 ) )
+		trace_events.append( dict( event, ph='e', ts=( end - trace_epoch ) * 1e6 ) )
+
+
+def traced_job( stage, path, queued, func, *args ):
+	"""Run a job on a worker, recording its wait since it was queued and its run as a stage"""
+	trace_span( 'queued', 'queue', queued, time.perf_counter(), path )
+	with trace_stage( stage, path ):
+		return func( *args )
+
+
+def save_trace( path ):
+	"""Write the recorded events as a Chrome/Perfetto trace JSON file"""
+	names = [ { 'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': { 'name': name } } for tid, name in trace_threads.items() ]
+	with open( path, 'w', encoding='utf_8' ) as trace_file:
+		json.dump( { 'traceEvents': names + trace_events, 'displayTimeUnit': 'ms' }, trace_file )
 
 
 #
@@ -504,212 +1218,34 @@ def get_tag( path ):
 	fields = dict()
 
 	if ext == '.m4a':
-		for line in subprocess.check_output( ( 'neroAacTag', path, '-list-meta' ), stderr=subprocess.DEVNULL ).decode().splitlines():
-			mat = AAC_TITLE_RE.match( line )
-			if mat:
-				fields['title'] = mat.group( 1 )
-				continue
-			mat = AAC_ARTIST_RE.match( line )
-			if mat:
-				fields['artist'] = mat.group( 1 )
-				continue
-			mat = AAC_ALBUM_RE.match( line )
-			if mat:
-				fields['album'] = mat.group( 1 )
-				continue
-			mat = AAC_TRACK_RE.match( line )
-			if mat:
-				fields['track'] = int( mat.group( 1 ) )
-				continue
-			mat = AAC_DISC_RE.match( line )
-			if mat:
-				fields['disc'] = int( mat.group( 1 ) )
-				continue
-			mat = AAC_GENRE_RE.match( line )
-			if mat:
-				fields['genre'] = mat.group( 1 )
-				continue
-			mat = AAC_YEAR_RE.match( line )
-			if mat:
-				fields['year'] = int( mat.group( 1 ) )
-				continue
-			mat = AAC_COMMENT_RE.match( line )
-			if mat:
-				fields['comment'] = mat.group( 1 )
-				continue
-		if 'front cover' in subprocess.check_output( ( 'neroAacTag', path, '-list-covers' ), stderr=subprocess.DEVNULL ).decode():
-			fields['cover'] = free_filename()
-			subprocess.check_call( ( 'neroAacTag', path, '-dump-cover:front:' + fields['cover'] ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		fields.update( read_mp4_metadata( path ) )
 	elif ext == '.flac':
-		for line in subprocess.check_output( ( 'metaflac', '--list', '--block-type=VORBIS_COMMENT', path ), stderr=subprocess.DEVNULL ).decode().splitlines():
-			mat = FLAC_TITLE_RE.match( line )
-			if mat:
-				fields['title'] = mat.group( 1 )
-				continue
-			mat = FLAC_ARTIST_RE.match( line )
-			if mat:
-				fields['artist'] = mat.group( 1 )
-				continue
-			mat = FLAC_ALBUM_RE.match( line )
-			if mat:
-				fields['album'] = mat.group( 1 )
-				continue
-			mat = FLAC_TRACK_RE.match( line )
-			if mat:
-				fields['track'] = int( mat.group( 1 ) )
-				continue
-			mat = FLAC_DISC_RE.match( line )
-			if mat:
-				fields['disc'] = int( mat.group( 1 ) )
-				continue
-			mat = FLAC_GENRE_RE.match( line )
-			if mat:
-				fields['genre'] = mat.group( 1 )
-				continue
-			mat = FLAC_YEAR_RE.match( line )
-			if mat:
-				fields['year'] = int( mat.group( 1 ) )
-				continue
-			mat = FLAC_COMMENT_RE.match( line )
-			if mat:
-				fields['comment'] = mat.group( 1 )
-				continue
-		if 'Cover (front)' in subprocess.check_output( ( 'metaflac', '--list', '--block-type=PICTURE', path ), stderr=subprocess.DEVNULL ).decode():
-			fields['cover'] = free_filename()
-			subprocess.check_call( ( 'metaflac', '--export-picture-to=' + fields['cover'], path ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		fields.update( read_flac_metadata( path ) )
 	elif ext == '.mp3':
+		# Map rather than read the file so only the tag regions are touched
 		with open( path, 'rb' ) as input_file:
-			input_data = input_file.read()
-		fields.update( read_id3v1( input_data ) )
-		fields.update( read_id3v2_header( input_data ) )
-		fields.update( read_id3v2_footer( input_data ) )
-		if 'cover' in fields:
-			with open( free_filename(), 'wb' ) as cover_file:
-				cover_file.write( fields['cover'] )
-				fields['cover'] = cover_file.name
-	elif ext == '.ogg':
-		for line in subprocess.check_output( ( 'vorbiscomment', '--list', path ), stderr=subprocess.DEVNULL ).decode().splitlines():
-			mat = VORBIS_TITLE_RE.match( line )
-			if mat:
-				fields['title'] = mat.group( 1 )
-				continue
-			mat = VORBIS_ARTIST_RE.match( line )
-			if mat:
-				fields['artist'] = mat.group( 1 )
-				continue
-			mat = VORBIS_ALBUM_RE.match( line )
-			if mat:
-				fields['album'] = mat.group( 1 )
-				continue
-			mat = VORBIS_TRACK_RE.match( line )
-			if mat:
-				fields['track'] = int( mat.group( 1 ) )
-				continue
-			mat = VORBIS_DISC_RE.match( line )
-			if mat:
-				fields['disc'] = int( mat.group( 1 ) )
-				continue
-			mat = VORBIS_GENRE_RE.match( line )
-			if mat:
-				fields['genre'] = mat.group( 1 )
-				continue
-			mat = VORBIS_YEAR_RE.match( line )
-			if mat:
-				fields['year'] = int( mat.group( 1 ) )
-				continue
-			mat = VORBIS_COMMENT_RE.match( line )
-			if mat:
-				fields['comment'] = mat.group( 1 )
-				continue
-			mat = VORBIS_COVER_RE.match( line )
-			if mat:
-				with open( free_filename() ) as cover_file:
-					cover_file.write( read_metadatablockpicture( base64.b64decode( mat.group( 1 ) ) ) )
-					fields['cover'] = cover_file.name
-				continue
-	elif ext == '.opus':
-		for line in subprocess.check_output( ( 'opusinfo', path ), stderr=subprocess.DEVNULL ).decode().splitlines():
-			mat = OPUS_TITLE_RE.match( line )
-			if mat:
-				fields['title'] = mat.group( 1 )
-				continue
-			mat = OPUS_ARTIST_RE.match( line )
-			if mat:
-				fields['artist'] = mat.group( 1 )
-				continue
-			mat = OPUS_ALBUM_RE.match( line )
-			if mat:
-				fields['album'] = mat.group( 1 )
-				continue
-			mat = OPUS_TRACK_RE.match( line )
-			if mat:
-				fields['track'] = int( mat.group( 1 ) )
-				continue
-			mat = OPUS_DISC_RE.match( line )
-			if mat:
-				fields['disc'] = int( mat.group( 1 ) )
-				continue
-			mat = OPUS_GENRE_RE.match( line )
-			if mat:
-				fields['genre'] = mat.group( 1 )
-				continue
-			mat = OPUS_YEAR_RE.match( line )
-			if mat:
-				fields['year'] = int( mat.group( 1 ) )
-				continue
-			mat = OPUS_COMMENT_RE.match( line )
-			if mat:
-				fields['comment'] = mat.group( 1 )
-				continue
-		# TODO Get Opus cover
+			if os.fstat( input_file.fileno() ).st_size > 0:
+				with mmap.mmap( input_file.fileno(), 0, access=mmap.ACCESS_READ ) as input_data:
+					fields.update( read_id3v1( input_data ) )
+					fields.update( read_id3v2_header( input_data ) )
+					fields.update( read_id3v2_footer( input_data ) )
+			fields.pop( 'pictures', None )
+	elif ext == '.ogg' or ext == '.opus':
+		fields.update( read_ogg_metadata( path ) )
 	elif ext == '.wav':
 		pass
 	elif ext == '.wv':
-		for line in subprocess.check_output( ( 'wvunpack', '-ss', path ), stderr=subprocess.DEVNULL ).decode().splitlines():
-			mat = WAVPACK_TITLE_RE.match( line )
-			if mat:
-				fields['title'] = mat.group( 1 )
-				continue
-			mat = WAVPACK_ARTIST_RE.match( line )
-			if mat:
-				fields['artist'] = mat.group( 1 )
-				continue
-			mat = WAVPACK_ALBUM_RE.match( line )
-			if mat:
-				fields['album'] = mat.group( 1 )
-				continue
-			mat = WAVPACK_TRACK_RE.match( line )
-			if mat:
-				fields['track'] = int( mat.group( 1 ) )
-				continue
-			mat = WAVPACK_DISC_RE.match( line )
-			if mat:
-				fields['disc'] = int( mat.group( 1 ) )
-				continue
-			mat = WAVPACK_GENRE_RE.match( line )
-			if mat:
-				fields['genre'] = mat.group( 1 )
-				continue
-			mat = WAVPACK_YEAR_RE.match( line )
-			if mat:
-				fields['year'] = int( mat.group( 1 ) )
-				continue
-			mat = WAVPACK_COMMENT_RE.match( line )
-			if mat:
-				fields['comment'] = mat.group( 1 )
-				continue
-			mat = WAVPACK_COVER_RE.match( line )
-			if mat:
-				fields['cover'] = free_filename()
-				subprocess.check_call( ( 'wvunpack', '-n', '-xx', 'Cover Art (Front)=' + fields['cover'] ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
-				continue
+		fields.update( read_apev2_tag( path ) )
 	else:
 		raise Exception( 'Reading tags from ' + ext + ' files is not supported.' )
 
+	if 'cover' in fields:
+		fields['cover'] = store_cover( fields['cover'] )
+
 	return fields
 
 
-def set_tag( path, tag ):
+def set_tag( path, tag, padding=ID3V2_PADDING ):
 	"""Set tag data in audio file"""
 	ext = os.path.splitext( path )[1].lower()
 	fields = dict()
@@ -737,7 +1273,7 @@ def set_tag( path, tag ):
 			tag_args += ( '-meta:comment=' + tag['comment'], )
 		if 'cover' in tag:
 			tag_args += ( '-add-cover:front:' + tag['cover'], )
-		subprocess.check_call( ( 'neroAacTag', out_path ) + tag_args )
+		subprocess.check_call( ( 'neroAacTag', path ) + tag_args )
 	elif ext == '.flac':
 		# Strip metadata
 		subprocess.check_call( ( 'metaflac', '--remove-all-tags', path ) )
@@ -764,17 +1300,38 @@ def set_tag( path, tag ):
 			tag_args += ( '--import-picture-from=' + tag['cover'], )
 		subprocess.check_call( ( 'metaflac', ) + tag_args + ( path, ) )
 	elif ext == '.mp3':
-		with open( path, 'rb' ) as mp3_file:
-			mp3_data = mp3_file.read()
-		mp3_data = remove_id3v1( mp3_data )
-		mp3_data = remove_id3v2_header( mp3_data )
+		# Overwrite the existing tag in place if the new one fits in it (padding included)
 		if len( tag ) > 0:
-			if 'cover' in tag:
-				with open( tag['cover'], 'rb' ) as cover_file:
-					tag['cover'] = cover_file.read()
-			mp3_data = write_id3v2_header( mp3_data, tag )
-		with open( path, 'wb' ) as mp3_file:
-			mp3_file.write( mp3_data )
+			frames = write_id3v2_frames( tag )
+			size = sum( map( len, frames ) )
+			with open( path, 'r+b' ) as mp3_file:
+				old_size = id3v2_header_size( mp3_file.read( 10 ) )
+				if 10 + size <= old_size:
+					with mmap.mmap( mp3_file.fileno(), 0, access=mmap.ACCESS_READ ) as mp3_data:
+						ranges = mp3_audio_ranges( mp3_data )
+					# Trailing tags can be cut off, but one between the audio and an APEv2 tag needs a rewrite
+					if len( ranges ) <= 1 and all( offset == old_size for offset, count in ranges ):
+						mp3_file.seek( 0 )
+						write_id3v2_file( mp3_file, frames, old_size - 10 - size )
+						mp3_file.truncate( sum( ranges[0] ) if len( ranges ) > 0 else old_size )
+						return
+		# Otherwise write the new tag and the untouched audio to a temporary file next to the original
+		out_file = tempfile.NamedTemporaryFile( dir=os.path.dirname( os.path.abspath( path ) ), delete=False )
+		try:
+			with open( path, 'rb' ) as mp3_file, out_file:
+				if len( tag ) > 0:
+					write_id3v2_file( out_file, frames, padding )
+				if os.fstat( mp3_file.fileno() ).st_size > 0:
+					with mmap.mmap( mp3_file.fileno(), 0, access=mmap.ACCESS_READ ) as mp3_data:
+						for offset, count in mp3_audio_ranges( mp3_data ):
+							for pos in range( offset, offset + count, COPY_CHUNK_SIZE ):
+								out_file.write( mp3_data[pos:min( pos + COPY_CHUNK_SIZE, offset + count )] )
+			shutil.copymode( path, out_file.name )
+			os.replace( out_file.name, path )
+		except BaseException:
+			# Do not leave the partial copy behind
+			os.remove( out_file.name )
+			raise
 	elif ext == '.ogg':
 		# Set everything but cover
 		tag_args = tuple()
@@ -794,15 +1351,15 @@ def set_tag( path, tag ):
 			tag_args += ( '--tag', 'DATE=' + str( tag['year'] ) )
 		if 'comment' in tag:
 			tag_args += ( '--tag', 'COMMENT=' + tag['comment'] )
-		subprocess.check_call( ( 'vorbiscomment', '--write', tag_args, path ) )
+		subprocess.check_call( ( 'vorbiscomment', '--write' ) + tag_args + ( path, ) )
 		# Set cover
 		if 'cover' in tag:
 			with tempfile.NamedTemporaryFile( suffix='.tmp', dir=tmpdir.name ) as vcf:
 				vcf.write( b'METADATA_BLOCK_PICTURE=' )
-				vcf.write( base64.b64encode( write_metadatablockpicture( tag['cover'] ) ) )
+				vcf.write( load_cover( tag['cover'], 'mbp_base64' ) )
 				vcf.write( b'\n' )
 				vcf.flush()
-				subprocess.check_call( ( 'vorbiscomment', '-a', out_path, '-c', vcf.name ) )
+				subprocess.check_call( ( 'vorbiscomment', '-a', path, '-c', vcf.name ) )
 	elif ext == '.opus':
 		raise Exception( 'Setting tags in ' + ext + ' files is not supported!' )
 	elif ext == '.wav':
@@ -813,21 +1370,210 @@ def set_tag( path, tag ):
 		raise Exception( 'Setting tags in ' + ext + ' files is not supported!' )
 
 
+def is_same_file( in_path, out_path ):
+	"""Tell whether an output path names the input file itself, which writing it would destroy"""
+	return os.path.exists( out_path ) and os.path.samefile( in_path, out_path )
+
+
+def copy_file_data( in_file, out_file, offset, count ):
+	"""Append a byte range of one file to another, inside the kernel where possible"""
+	out_file.flush()
+	try:
+		while count > 0:
+			copied = os.copy_file_range( in_file.fileno(), out_file.fileno(), min( count, 1 << 30 ), offset )
+			if copied == 0:
+				break
+			offset += copied
+			count -= copied
+	except ( AttributeError, OSError ):
+		pass
+	# Fall back to user space for what is left (other file systems, older kernels)
+	in_file.seek( offset )
+	while count > 0:
+		data = in_file.read( min( count, COPY_CHUNK_SIZE ) )
+		if len( data ) == 0:
+			break
+		out_file.write( data )
+		count -= len( data )
+
+
+def clone_file( in_path, out_path ):
+	"""Copy a file by reflink where the file system supports it, otherwise inside the kernel"""
+	if is_same_file( in_path, out_path ):
+		raise Exception( 'Cannot copy a file onto itself: ' + in_path )
+	with open( in_path, 'rb' ) as in_file, open( out_path, 'wb', buffering=0 ) as out_file:
+		try:
+			fcntl.ioctl( out_file.fileno(), FICLONE, in_file.fileno() )
+		except OSError:
+			copy_file_data( in_file, out_file, 0, os.fstat( in_file.fileno() ).st_size )
+	shutil.copymode( in_path, out_path )
+
+
+def copy_with_tag( in_path, out_path, tag, padding=ID3V2_PADDING, changed=None ):
+	"""Copy an audio file with a new tag, writing the tag and streaming the audio only once (changed=None compares with the tag of the source)"""
+	ext = os.path.splitext( in_path )[1].lower()
+	if is_same_file( in_path, out_path ):
+		raise Exception( 'Cannot copy a file onto itself: ' + in_path )
+	if changed is None:
+		changed = tag != get_tag( in_path )
+
+	if not changed:
+		clone_file( in_path, out_path )
+	elif ext == '.mp3':
+		with open( in_path, 'rb' ) as in_file, open( out_path, 'wb', buffering=0 ) as out_file:
+			if len( tag ) > 0:
+				write_id3v2_file( out_file, write_id3v2_frames( tag ), padding )
+			if os.fstat( in_file.fileno() ).st_size > 0:
+				with mmap.mmap( in_file.fileno(), 0, access=mmap.ACCESS_READ ) as mp3_data:
+					ranges = mp3_audio_ranges( mp3_data )
+				for offset, count in ranges:
+					copy_file_data( in_file, out_file, offset, count )
+		shutil.copymode( in_path, out_path )
+	elif ext == '.flac':
+		with open( in_path, 'rb' ) as in_file, open( out_path, 'wb', buffering=0 ) as out_file:
+			write_flac_file( in_file, out_file, tag, padding )
+		shutil.copymode( in_path, out_path )
+	else:
+		clone_file( in_path, out_path )
+		set_tag( out_path, tag, padding )
+
+
+def gather_tag( path, new_tag, discard=False ):
+	"""Merge the existing tag of a file with new fields"""
+	if discard:
+		tag = dict( new_tag )
+	else:
+		tag = get_tag( path )
+		tag.update( new_tag )
+	return { k:v for k, v in tag.items() if ( v != 0 or len( v ) > 0 ) }
+
+
+def gather_tag_change( path, new_tag, discard=False ):
+	"""Merge the existing tag of a file with new fields and tell whether that changes it"""
+	old_tag = get_tag( path )
+	tag = dict( new_tag ) if discard else dict( old_tag )
+	if not discard:
+		tag.update( new_tag )
+	tag = { k:v for k, v in tag.items() if ( v != 0 or len( v ) > 0 ) }
+	return tag, tag != old_tag
+
+
 #
 # Audio codec functions
 #
 
 
-def convert_audio_format( in_path, out_path, tag=dict() ):
+@functools.lru_cache( maxsize=None )
+def find_tool( name ):
+	"""Look up an external tool on the PATH once per run"""
+	return shutil.which( name )
+
+
+@functools.lru_cache( maxsize=None )
+def ffmpeg_encoders():
+	"""List the audio encoders of the ffmpeg on the PATH once per run (none without ffmpeg)"""
+	if find_tool( 'ffmpeg' ) is None:
+		return frozenset()
+	try:
+		output = subprocess.run( ( 'ffmpeg', '-hide_banner', '-encoders' ), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True ).stdout
+	except ( OSError, subprocess.CalledProcessError ):
+		return frozenset()
+	encoders = set()
+	for line in output.decode( 'utf_8', 'replace' ).split( '\n' ):
+		fields = line.split()
+		# Capability flags, then the name; audio encoders are flagged A
+		if len( fields ) >= 2 and len( fields[0] ) == 6 and fields[0][0] == 'A':
+			encoders.add( fields[1] )
+	return frozenset( encoders )
+
+
+@functools.lru_cache( maxsize=None )
+def encoder_accepts( encoder, option ):
+	"""Check once per run whether an encoder on the PATH lists an option in its help (options vary between versions)"""
+	if find_tool( encoder ) is None:
+		return False
+	try:
+		output = subprocess.run( ( encoder, '--help' ), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT ).stdout
+	except OSError:
+		return False
+	return option.encode() in output
+
+
+@functools.lru_cache( maxsize=None )
+def select_encoder( out_ext, backend='pipe' ):
+	"""Choose the preferred available encoder of a format for a backend once per run (None if there is none)"""
+	if backend == 'ffmpeg':
+		for encoder in FFMPEG_OPTIONS[out_ext]:
+			if encoder in ffmpeg_encoders():
+				return encoder
+	else:
+		for encoder in ENCODER_OPTIONS[out_ext]:
+			if find_tool( encoder ) is not None:
+				return encoder
+	return None
+
+
+def output_backend( out_ext, tag, backend='pipe' ):
+	"""Return the backend that produces an output: ffmpeg where it can encode and tag the format, otherwise the pipe backend"""
+	# WAV has no tag either backend could write
+	if backend == 'ffmpeg' and select_encoder( out_ext, 'ffmpeg' ) is not None and ( 'cover' not in tag or out_ext in FFMPEG_COVER_FORMATS or out_ext == '.ogg' or out_ext == '.wav' ):
+		return 'ffmpeg'
+	return 'pipe'
+
+
+@functools.lru_cache( maxsize=None )
+def warn_pipe_fallback( out_ext ):
+	"""Warn once per run that ffmpeg leaves a format to the pipe backend"""
+	print( 'WARNING: The ffmpeg backend cannot write ' + out_ext + ' files with their tag (e.g. a cover).  Using the pipe backend for them...' )
+
+
+def probe_backends( out_exts, backend='pipe' ):
+	"""Probe the tools needed to encode the formats up front and return the formats that cannot be encoded"""
+	missing = list()
+	for out_ext in out_exts:
+		if backend == 'ffmpeg' and select_encoder( out_ext, 'ffmpeg' ) is not None:
+			continue
+		# Jobs ffmpeg cannot do fall back to the pipe backend, which writes WAV itself
+		if out_ext != '.wav' and select_encoder( out_ext ) is None:
+			missing.append( out_ext )
+		elif out_ext == '.flac':
+			# Only flac 1.5 and later can encode with several threads
+			encoder_accepts( 'flac', '--threads' )
+	return missing
+
+
+def convert_audio_format( in_path, out_paths, tag=dict(), threads=1, backend='pipe' ):
+	"""Decode an audio file once and encode it to each of the output paths"""
 	# Format check
 	in_ext = os.path.splitext( in_path )[1].lower()
-	out_ext = os.path.splitext( out_path )[1].lower()
+	out_exts = [ os.path.splitext( out_path )[1].lower() for out_path in out_paths ]
 	if in_ext not in FORMAT_EXT_MAP.values():
 		raise Exception( 'The ' + in_ext + ' format is not supported and cannot be decoded.' )
-	if out_ext not in FORMAT_EXT_MAP.values():
-		raise Exception( 'The ' + out_ext + ' format is not supported and cannot be encoded.' )
-
-	# Setup decode process
+	for out_ext in out_exts:
+		if out_ext not in FORMAT_EXT_MAP.values():
+			raise Exception( 'The ' + out_ext + ' format is not supported and cannot be encoded.' )
+	for out_path in out_paths:
+		if is_same_file( in_path, out_path ):
+			raise Exception( 'Cannot transcode a file onto itself: ' + in_path )
+
+	# Let ffmpeg do the outputs it can encode and tag in one process, and the pipe backend the others
+	if backend == 'ffmpeg':
+		ffmpeg_paths = [ out_path for out_path, out_ext in zip( out_paths, out_exts ) if output_backend( out_ext, tag, backend ) == 'ffmpeg' ]
+		if len( ffmpeg_paths ) > 0:
+			with trace_stage( 'ffmpeg', in_path ):
+				convert_audio_format_ffmpeg( in_path, ffmpeg_paths, tag )
+			for out_path in ffmpeg_paths:
+				with trace_stage( 'post-tag', out_path ):
+					finish_encoder( out_path, tag, 'ffmpeg' )
+		out_paths = [ out_path for out_path in out_paths if out_path not in ffmpeg_paths ]
+		out_exts = [ os.path.splitext( out_path )[1].lower() for out_path in out_paths ]
+		for out_ext in out_exts:
+			warn_pipe_fallback( out_ext )
+		if len( out_paths ) == 0:
+			return
+
+	# Setup decode process, except for WAV which is read directly
+	started = time.perf_counter()
 	if in_ext == '.m4a':
 		dec_proc = subprocess.Popen( ( 'neroAacDec', '-if', in_path, '-of', '-' ), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL )
 	elif in_ext == '.flac':
@@ -839,34 +1585,170 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 	elif in_ext == '.ogg':
 		dec_proc = subprocess.Popen( ( 'oggdec',  '--output=-', in_path ), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL )
 	elif in_ext == '.wav':
-		dec_proc = subprocess.Popen( ( 'cat', in_path ), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL )
+		dec_proc = None
 	elif in_ext == '.wv':
 		dec_proc = subprocess.Popen( ( 'wvunpack', in_path, '-o', '-' ), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL )
 	else:
 		assert False
 
-	# Setup encode process
+	pcm = open( in_path, 'rb' ) if dec_proc is None else dec_proc.stdout
+
+	# Setup encode processes, fed straight from the decoder or through a tee for several formats (WAV is written directly)
+	enc_procs = list()
+	if len( out_paths ) == 1 and out_exts[0] != '.wav':
+		enc_procs.append( ( out_paths[0], start_encoder( out_paths[0], tag, threads, pcm ), time.perf_counter() ) )
+	elif len( out_paths ) == 1 and dec_proc is None:
+		clone_file( in_path, out_paths[0] )
+	elif len( out_paths ) == 1:
+		with open( out_paths[0], 'wb', buffering=0 ) as out_file, trace_stage( 'write', out_paths[0] ):
+			splice_pipe( pcm, out_file )
+	else:
+		sinks = list()
+		for out_path, out_ext in zip( out_paths, out_exts ):
+			if out_ext == '.wav':
+				sinks.append( open( out_path, 'wb' ) )
+			else:
+				enc_procs.append( ( out_path, start_encoder( out_path, tag, threads, subprocess.PIPE ), time.perf_counter() ) )
+				sinks.append( enc_procs[-1][1].stdin )
+		with trace_stage( 'tee', in_path ):
+			tee_pipe( pcm, sinks )
+
+	# Wait for decoding/encoding to finish
+	pcm.close()
+	if dec_proc is not None:
+		status = dec_proc.wait()
+		trace_span( 'decode', 'process', started, time.perf_counter(), in_path )
+		if status:
+			raise Exception( 'Error occurred in ' + in_ext + ' decoding process.' )
+	failed = list()
+	for out_path, enc_proc, enc_started in enc_procs:
+		if enc_proc.wait():
+			failed.append( os.path.splitext( out_path )[1].lower() )
+		trace_span( 'encode', 'process', enc_started, time.perf_counter(), out_path )
+	if len( failed ) > 0:
+		raise Exception( 'Error occurred in ' + ', '.join( failed ) + ' encoding process.' )
+
+	for out_path in out_paths:
+		with trace_stage( 'post-tag', out_path ):
+			finish_encoder( out_path, tag )
+
+
+def convert_audio_format_ffmpeg( in_path, out_paths, tag ):
+	"""Decode, encode and tag an audio file to each of the output paths in a single ffmpeg process"""
+	tag_args = tuple()
+	if 'title' in tag:
+		tag_args += ( '-metadata', 'title=' + tag['title'] )
+	if 'artist' in tag:
+		tag_args += ( '-metadata', 'artist=' + tag['artist'] )
+	if 'album' in tag:
+		tag_args += ( '-metadata', 'album=' + tag['album'] )
+	if 'track' in tag:
+		tag_args += ( '-metadata', 'track=' + str( tag['track'] ) )
+	if 'disc' in tag:
+		tag_args += ( '-metadata', 'disc=' + str( tag['disc'] ) )
+	if 'genre' in tag:
+		tag_args += ( '-metadata', 'genre=' + tag['genre'] )
+	if 'year' in tag:
+		tag_args += ( '-metadata', 'date=' + str( tag['year'] ) )
+	if 'comment' in tag:
+		tag_args += ( '-metadata', 'comment=' + tag['comment'] )
+
+	args = ( 'ffmpeg', '-hide_banner', '-nostdin', '-y', '-i', in_path )
+	if 'cover' in tag:
+		args += ( '-i', tag['cover'] )
+	for out_path in out_paths:
+		out_ext = os.path.splitext( out_path )[1].lower()
+		encoder = select_encoder( out_ext, 'ffmpeg' )
+		if out_ext == '.wav':
+			# Keep the bits per sample of the source like the pipe backend, rather than ffmpeg's 16 bit default
+			encoder = WAV_PCM_CODECS.get( read_bit_depth( in_path ), encoder )
+		args += ( '-map', '0:a' )
+		if 'cover' in tag and out_ext in FFMPEG_COVER_FORMATS:
+			args += ( '-map', '1:v', '-c:v', 'copy', '-disposition:v', 'attached_pic' )
+		args += ( '-map_metadata', '-1', '-c:a', encoder ) + FFMPEG_OPTIONS[out_ext].get( encoder, () ) + tag_args + ( out_path, )
+
+	if subprocess.call( args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL ):
+		raise Exception( 'Error occurred in ffmpeg transcoding process.' )
+
+
+def read_bit_depth( path ):
+	"""Return the bits per sample of a FLAC, WAV or WavPack file (16 for lossy formats, which decode to 16 bit)"""
+	ext = os.path.splitext( path )[1].lower()
+
+	with open( path, 'rb' ) as audio_file:
+		header = audio_file.read( 12 )
+		if ext == '.flac':
+			# Skip over a (non-standard) leading ID3v2 tag
+			if len( header ) >= 10 and header[0:3] == b'ID3':
+				audio_file.seek( 10 + decode_synchsafe_int( header[6:10] ) + ( 10 if header[5] & 0x10 else 0 ) )
+			else:
+				audio_file.seek( 0 )
+			# STREAMINFO is always the first metadata block
+			data = audio_file.read( 42 )
+			if len( data ) == 42 and data[0:4] == b'fLaC':
+				return ( ( data[20] & 0x01 ) << 4 | data[21] >> 4 ) + 1
+		elif ext == '.wav' and header[0:4] == b'RIFF' and header[8:12] == b'WAVE':
+			while True:
+				chunk = audio_file.read( 8 )
+				if len( chunk ) < 8:
+					break
+				size = int.from_bytes( chunk[4:8], 'little' )
+				if chunk[0:4] == b'fmt ':
+					return int.from_bytes( audio_file.read( 16 )[14:16], 'little' )
+				audio_file.seek( size + ( size & 1 ), os.SEEK_CUR )
+		elif ext == '.wv' and header[0:4] == b'wvpk':
+			audio_file.seek( 24 )
+			return ( ( int.from_bytes( audio_file.read( 4 ), 'little' ) & 0x03 ) + 1 ) * 8
+
+	return 16
+
+
+def clone_or_convert( in_path, out_path, tag, backend='pipe' ):
+	"""Clone a file already in the format of its output when that keeps its tag, otherwise transcode it"""
+	if tag == get_tag( in_path ):
+		clone_file( in_path, out_path )
+	else:
+		convert_audio_format( in_path, ( out_path, ), tag, 1, backend )
+
+
+def splice_pipe( in_pipe, out_file ):
+	"""Write everything read from a pipe to a file, moving it inside the kernel where possible"""
+	try:
+		while os.splice( in_pipe.fileno(), out_file.fileno(), COPY_CHUNK_SIZE ) > 0:
+			pass
+		return
+	except ( AttributeError, OSError ):
+		pass
+	# Fall back to user space (other platforms, file systems without splice support)
+	shutil.copyfileobj( in_pipe, out_file, COPY_CHUNK_SIZE )
+
+
+def tee_pipe( in_pipe, out_pipes ):
+	"""Copy everything read from one pipe to several, dropping those whose reader went away"""
+	open_pipes = list( out_pipes )
+	while len( open_pipes ) > 0:
+		data = in_pipe.read1( COPY_CHUNK_SIZE )
+		if len( data ) == 0:
+			break
+		for out_pipe in tuple( open_pipes ):
+			try:
+				out_pipe.write( data )
+			except BrokenPipeError:
+				open_pipes.remove( out_pipe )
+	for out_pipe in out_pipes:
+		try:
+			out_pipe.close()
+		except BrokenPipeError:
+			pass
+
+
+def start_encoder( out_path, tag, threads=1, stdin=None ):
+	"""Start the encoding process of an output file reading PCM from stdin"""
+	out_ext = os.path.splitext( out_path )[1].lower()
+
 	if out_ext == '.m4a':
-		#if shutil.which( 'ffmpeg' ) is not None:
-		#	tag_args = tuple()
-		#	if 'title' in tag:
-		#		tag_args += ( '-metadata', 'title=' + tag['title'] )
-		#	if 'artist' in tag:
-		#		tag_args += ( '-metadata', 'artist=' + tag['artist'] )
-		#	if 'album' in tag:
-		#		tag_args += ( '-metadata', 'album=' + tag['album'] )
-		#	if 'track' in tag:
-		#		tag_args += ( '-metadata', 'track=' + str( tag['track'] ) )
-		#	if 'disc' in tag:
-		#		tag_args += ( '-metadata', 'disc=' + str( tag['disc'] ) )
-		#	if 'genre' in tag:
-		#		tag_args += ( '-metadata', 'genre=' + tag['genre'] )
-		#	if 'year' in tag:
-		#		tag_args += ( '-metadata', 'date=' + str( tag['year'] ) )
-		#	if 'comment' in tag:
-		#		tag_args += ( '-metadata', 'comment=' + tag['comment'] )
-		#	enc_proc = subprocess.Popen( ( 'ffmpeg', '-i', '-' ) + tag_args + ( '-c:a', 'aac', '-q:a', '1.0', out_path ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
-		if shutil.which( 'fdkaac' ) is not None:
+		encoder = select_encoder( out_ext )
+		if encoder == 'fdkaac':
 			tag_args = tuple()
 			if 'title' in tag:
 				tag_args += ( '--title', tag['title'] )
@@ -886,10 +1768,10 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 				tag_args += ( '--comment', tag['comment'] )
 			if 'cover' in tag:
 				tag_args += ( '--tag-from-file', 'covr:' + tag['cover'] )
-			enc_proc = subprocess.Popen( ( 'fdkaac', '-m', '4' ) + tag_args + ( '-o', out_path, '-' ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
-		elif shutil.which( 'neroAacEnc' ) is not None:
-			enc_proc = subprocess.Popen( ( 'neroAacEnc', '-ignorelength', '-q', '0.4', '-if', '-', '-of', out_path ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
-		elif shutil.which( 'faac' ) is not None:
+			enc_proc = subprocess.Popen( ( 'fdkaac', ) + ENCODER_OPTIONS['.m4a']['fdkaac'] + tag_args + ( '-o', out_path, '-' ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		elif encoder == 'neroAacEnc':
+			enc_proc = subprocess.Popen( ( 'neroAacEnc', '-ignorelength' ) + ENCODER_OPTIONS['.m4a']['neroAacEnc'] + ( '-if', '-', '-of', out_path ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		elif encoder == 'faac':
 			tag_args = tuple()
 			if 'title' in tag:
 				tag_args += ( '--title', tag['title'] )
@@ -909,7 +1791,7 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 				tag_args += ( '--comment', tag['comment'] )
 			if 'cover' in tag:
 				tag_args += ( '--cover-art', tag['cover'] )
-			enc_proc = subprocess.Popen( ( 'faac', ) + tag_args + ( '-o', out_path, '-' ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+			enc_proc = subprocess.Popen( ( 'faac', ) + ENCODER_OPTIONS['.m4a']['faac'] + tag_args + ( '-o', out_path, '-' ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
 		else:
 			raise Exception( 'No suitable AAC compressor found!' )
 	elif out_ext == '.flac':
@@ -932,7 +1814,7 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 			tag_args += ( '--tag=COMMENT=' + tag['comment'], )
 		if 'cover' in tag:
 			tag_args += ( '--picture=' + tag['cover'], )
-		enc_proc = subprocess.Popen( ( 'flac', '--best' ) + tag_args + ( '--output-name=' + out_path, '-' ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		enc_proc = subprocess.Popen( ( 'flac', ) + ENCODER_OPTIONS['.flac']['flac'] + ( ( '--threads=' + str( threads ), ) if threads > 1 and encoder_accepts( 'flac', '--threads' ) else () ) + tag_args + ( '--output-name=' + out_path, '-' ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
 	elif out_ext == '.mp3':
 		tag_args = tuple()
 		if 'title' in tag:
@@ -953,7 +1835,7 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 			tag_args += ( '--tc', tag['comment'] )
 		if 'cover' in tag:
 			tag_args += ( '--ti', tag['cover'] )
-		enc_proc = subprocess.Popen( ( 'lame', '-V', '0' ) + tag_args + ( '-', out_path ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		enc_proc = subprocess.Popen( ( 'lame', ) + ENCODER_OPTIONS['.mp3']['lame'] + tag_args + ( '-', out_path ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
 	elif out_ext == '.opus':
 		tag_args = tuple()
 		if 'title' in tag:
@@ -974,7 +1856,7 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 			tag_args += ( '--comment', 'comment=' + tag['comment'] )
 		if 'cover' in tag:
 			tag_args += ( '--picture', tag['cover'] )
-		enc_proc = subprocess.Popen( ( 'opusenc', ) + tag_args + ( '-', out_path ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		enc_proc = subprocess.Popen( ( 'opusenc', ) + ENCODER_OPTIONS['.opus']['opusenc'] + tag_args + ( '-', out_path ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
 	elif out_ext == '.ogg':
 		tag_args = tuple()
 		if 'title' in tag:
@@ -993,9 +1875,7 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 			tag_args += ( '--date', str( tag['year'] ) )
 		if 'comment' in tag:
 			tag_args += ( '--comment', 'comment=' + tag['comment'] )
-		enc_proc = subprocess.Popen( ( 'oggenc', ) + tag_args + ( '--output=' + out_path, '-' ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
-	elif out_ext == '.wav':
-		enc_proc = subprocess.Popen( ( 'tee', out_path ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+		enc_proc = subprocess.Popen( ( 'oggenc', ) + ENCODER_OPTIONS['.ogg']['oggenc'] + tag_args + ( '--output=' + out_path, '-' ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
 	elif out_ext == '.wv':
 		tag_args = tuple()
 		if 'title' in tag:
@@ -1015,27 +1895,20 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 		if 'comment' in tag:
 			tag_args += ( '-w', 'Comment=' + tag['comment'] )
 		if 'cover' in tag:
-			cover_file.write( tag['cover'] )
-			tag_args += ( '--write-binary-tag', 'Cover Art (Front)=@' + cover_file.name )
-			cover_file.flush()
-		enc_proc = subprocess.Popen( ( 'wavpack', ) + tag_args + ( '-', '-o', out_path ), stdin=dec_proc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+			tag_args += ( '--write-binary-tag', 'Cover Art (Front)=@' + tag['cover'] )
+		enc_proc = subprocess.Popen( ( 'wavpack', ) + ENCODER_OPTIONS['.wv']['wavpack'] + tag_args + ( '-', '-o', out_path ), stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
 	else:
 		assert False
 
-	# Wait for decoding/encoding to finish
-	dec_proc.stdout.close()
-	if dec_proc.wait():
-		raise Exception( 'Error occurred in ' + in_ext + ' decoding process.' )
-	if enc_proc.wait():
-		raise Exception( 'Error occurred in ' + out_ext + ' encoding process.' )
+	return enc_proc
 
-	if out_ext == '.m4a':
-		if shutil.which( 'ffmpeg' ) is not None:
-			if 'cover' in tag:
-				subprocess.check_call( ( 'MP4Box', '-itags', 'cover=' + tag['cover'], out_path ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
-		elif shutil.which( 'fdkaac' ) is not None:
-			pass
-		elif shutil.which( 'neroAacTag' ) is not None:
+
+def finish_encoder( out_path, tag, backend='pipe' ):
+	"""Add the tag fields the encoder of an output file could not write itself"""
+	out_ext = os.path.splitext( out_path )[1].lower()
+
+	if out_ext == '.m4a' and backend == 'pipe':
+		if select_encoder( out_ext ) == 'neroAacEnc' and find_tool( 'neroAacTag' ) is not None:
 			tag_args = tuple()
 			if 'title' in tag:
 				tag_args += ( '-meta:title=' + tag['title'], )
@@ -1060,12 +1933,192 @@ def convert_audio_format( in_path, out_path, tag=dict() ):
 	if out_ext == '.ogg' and 'cover' in tag:
 		with tempfile.NamedTemporaryFile( suffix='.tmp', dir=tmpdir.name ) as vcf:
 			vcf.write( b'METADATA_BLOCK_PICTURE=' )
-			vcf.write( base64.b64encode( write_metadatablockpicture( tag['cover'] ) ) )
+			vcf.write( load_cover( tag['cover'], 'mbp_base64' ) )
 			vcf.write( b'\n' )
 			vcf.flush()
 			subprocess.check_call( ( 'vorbiscomment', '-a', out_path, '-c', vcf.name ) )
 
 
+def writable_outputs( paths, force=False, action='Skipping', source=None ):
+	"""Keep the output paths that do not exist yet or may be overwritten, warning about the others"""
+	kept = tuple()
+	for path in paths:
+		# A source that is its own output is retagged if its format allows, and otherwise already done
+		if path == source and os.path.splitext( path )[1].lower() not in RETAG_FORMATS:
+			continue
+		elif not os.path.exists( path ) or force or path == source:
+			kept += ( path, )
+		else:
+			print( 'WARNING: Cannot overwrite ("', path, '") existing file without --force.  ', action, '...', sep=str() )
+	return kept
+
+
+def walk_jobs( in_path, out_paths=(), transcodes=(), force=False, incremental=False, outputs=frozenset() ):
+	"""Generate the ( input, outputs, mode ) jobs of a run as it walks, where mode is 'tag', 'copy' or 'transcode' (outputs lists the normalized paths of earlier in-place outputs, which are not sources)"""
+	if len( out_paths ) == 0:
+		# inplace
+		if os.path.isfile( in_path ):
+			# non recursive
+			if len( transcodes ) == 0:
+				# don't transcode
+				yield in_path, ( in_path, ), 'tag'
+			else:
+				# transcode
+				new_paths = writable_outputs( [ os.path.splitext( in_path )[0] + FORMAT_EXT_MAP[transcode] for transcode in transcodes ], force, 'Cancelling', in_path )
+				if len( new_paths ) > 0:
+					yield in_path, new_paths, 'transcode'
+		else:
+			# recursive
+			for dirname, dirnames, filenames in os.walk( in_path ):
+				for filename in filenames:
+					path = os.path.join( dirname, filename )
+					head, tail = os.path.splitext( path )
+					if tail.lower() in FORMAT_EXT_MAP.values() and os.path.normpath( path ) not in outputs:
+						if len( transcodes ) == 0:
+							# don't transcode
+							yield path, ( path, ), 'tag'
+						else:
+							# transcode
+							new_paths = writable_outputs( [ head + FORMAT_EXT_MAP[transcode] for transcode in transcodes ], force or incremental, 'Skipping', path )
+							if len( new_paths ) > 0:
+								yield path, new_paths, 'transcode'
+	else:
+		# new file
+		if os.path.isfile( in_path ):
+			# non recursive
+			if len( transcodes ) == 0 and os.path.splitext( in_path )[1].lower() == os.path.splitext( out_paths[0] )[1].lower():
+				# don't transcode
+				new_paths = writable_outputs( out_paths, force )
+				if len( new_paths ) > 0:
+					yield in_path, new_paths, 'copy'
+			else:
+				# transcode
+				new_paths = writable_outputs( out_paths, force, 'Cancelling' )
+				if len( new_paths ) > 0:
+					yield in_path, new_paths, 'transcode'
+		else:
+			# recursive, into one tree per format
+			for old_dirpath, dirnames, filenames in os.walk( in_path ):
+				new_dirpaths = [ os.path.normpath( os.path.join( out_path, os.path.relpath( old_dirpath, in_path ) ) ) for out_path in out_paths ]
+				for new_dirpath in new_dirpaths:
+					if not os.path.exists( new_dirpath ):
+						os.mkdir( new_dirpath )
+				for filename in filenames:
+					old_path = os.path.join( old_dirpath, filename )
+					if len( transcodes ) == 0:
+						# don't transcode
+						new_paths = writable_outputs( [ os.path.join( new_dirpaths[0], filename ) ], force )
+						if len( new_paths ) > 0:
+							yield old_path, new_paths, 'copy'
+					else:
+						# transcode
+						new_paths = writable_outputs( [ os.path.join( new_dirpath, os.path.splitext( filename )[0] + FORMAT_EXT_MAP[transcode] ) for new_dirpath, transcode in zip( new_dirpaths, transcodes ) ], force or incremental )
+						if len( new_paths ) > 0:
+							yield old_path, new_paths, 'transcode'
+
+
+
+def estimate_job_cost( in_path ):
+	"""Estimate the cost of transcoding a file as its approximate duration in seconds"""
+	return os.path.getsize( in_path ) / FORMAT_BYTE_RATES.get( os.path.splitext( in_path )[1].lower(), 176400 )
+
+
+#
+# Manifest functions
+#
+
+
+def load_manifest( path ):
+	"""Load an incremental transcode manifest (empty if there is none yet)"""
+	if not os.path.exists( path ):
+		return dict()
+	with open( path, 'r', encoding='utf_8' ) as manifest_file:
+		return json.load( manifest_file )
+
+
+def save_manifest( path, manifest ):
+	"""Atomically save an incremental transcode manifest"""
+	with tempfile.NamedTemporaryFile( 'w', encoding='utf_8', dir=os.path.dirname( os.path.abspath( path ) ), delete=False ) as manifest_file:
+		json.dump( manifest, manifest_file, indent='\t', sort_keys=True )
+	os.replace( manifest_file.name, path )
+
+
+def fingerprint_file( path, size ):
+	"""Fingerprint the whole content of a file, so that edits anywhere in it are noticed"""
+	digest = hashlib.sha1( str( size ).encode() )
+	with open( path, 'rb' ) as in_file:
+		for data in iter( functools.partial( in_file.read, COPY_CHUNK_SIZE ), b'' ):
+			digest.update( data )
+	return digest.hexdigest()
+
+
+def fingerprint_tag( tag ):
+	"""Fingerprint the effective tag of a job, by content for the cover"""
+	tag = dict( tag )
+	if 'cover' in tag:
+		tag['cover'] = cover_digest( tag['cover'] )
+	return hashlib.sha1( json.dumps( tag, sort_keys=True ).encode() ).hexdigest()
+
+
+def encoder_settings( out_ext, tag, backend='pipe' ):
+	"""Describe the backend, encoder and options that produce a format, so that changing any of them invalidates outputs"""
+	if output_backend( out_ext, tag, backend ) == 'ffmpeg':
+		encoder = select_encoder( out_ext, 'ffmpeg' )
+		return { 'backend': 'ffmpeg', 'encoder': encoder, 'options': list( FFMPEG_OPTIONS[out_ext][encoder] ) }
+	encoder = select_encoder( out_ext )
+	return { 'backend': 'pipe', 'encoder': encoder, 'options': list( ENCODER_OPTIONS[out_ext].get( encoder, () ) ) }
+
+
+def make_manifest_record( in_path, tag, out_ext, old_record=None, backend='pipe' ):
+	"""Describe a transcode job by its source, effective tag, target format and encoder settings"""
+	stat = os.stat( in_path )
+	# Only rehash sources whose size or modification time changed
+	if old_record is not None and old_record['size'] == stat.st_size and old_record['mtime'] == stat.st_mtime_ns:
+		fingerprint = old_record['fingerprint']
+	else:
+		fingerprint = fingerprint_file( in_path, stat.st_size )
+	return {
+		'size':			stat.st_size,
+		'mtime':		stat.st_mtime_ns,
+		'fingerprint':	fingerprint,
+		'tag':			fingerprint_tag( tag ),
+		'format':		out_ext,
+		'settings':		encoder_settings( out_ext, tag, backend )
+	}
+
+
+def gather_tag_records( in_path, new_tag, discard, out_exts, old_records, backend='pipe' ):
+	"""Merge the tag of a file like gather_tag and describe its transcode job to each format for the manifests"""
+	tag = gather_tag( in_path, new_tag, discard )
+	records = list()
+	for out_ext, old_record in zip( out_exts, old_records ):
+		# The first record already holds the current fingerprint of the source
+		records.append( make_manifest_record( in_path, tag, out_ext, old_record if len( records ) == 0 else records[0], backend ) )
+	return tag, records
+
+
+def retag_record( path, tag, padding=ID3V2_PADDING, backend='pipe' ):
+	"""Retag a file in place and describe it afresh for the manifest, since it is its own source"""
+	set_tag( path, tag, padding )
+	return make_manifest_record( path, tag, os.path.splitext( path )[1].lower(), None, backend )
+
+
+def is_up_to_date( out_path, record, old_record, tag ):
+	"""Check whether the output of a transcode job is current according to the manifest"""
+	if not os.path.exists( out_path ):
+		return False
+	if old_record is None:
+		# Adopt outputs made before the manifest existed only if they are newer than their source and carry its tag
+		if os.stat( out_path ).st_mtime_ns < record['mtime']:
+			return False
+		try:
+			out_tag = get_tag( out_path )
+		except Exception:
+			return False
+		return { k:v for k, v in out_tag.items() if k != 'timestamp' } == { k:v for k, v in tag.items() if k != 'timestamp' }
+	return all( record[k] == old_record.get( k ) for k in ( 'fingerprint', 'tag', 'format', 'settings' ) )
+
+
 #
 # Program entry point
 #
@@ -1076,11 +2129,14 @@ def main( argv=None ):
 
 	# Parse command line
 	command_line_parser = argparse.ArgumentParser( description='simple audio manipulator' )
-	command_line_parser.add_argument( '-x', '--transcode', choices=FORMAT_EXT_MAP.keys(), help='transcode to a different format' )
+	command_line_parser.add_argument( '-x', '--transcode', action='append', default=list(), choices=FORMAT_EXT_MAP.keys(), help='transcode to a different format (repeat to encode several formats from one decode, one OUTFILE each)' )
+	command_line_parser.add_argument( '--reencode', action='store_true', help='re-encode files already in the target format instead of copying them (files are still only retagged in place)' )
 	command_line_parser.add_argument( '-r', '--recursive', action='store_true', help='allow directory input' )
 	command_line_parser.add_argument( '-f', '--force', action='store_true', help='allows output to overwrite input' )
+	command_line_parser.add_argument( '-i', '--incremental', action='store_true', help='only transcode files whose source, tag or encoder settings changed' )
+	command_line_parser.add_argument( '--manifest', help='manifest used by incremental runs with a single format (default: ' + MANIFEST_FILENAME + ' in the output directory)', metavar='FILENAME' )
 	command_line_parser.add_argument( 'infile', metavar='INFILE' )
-	command_line_parser.add_argument( 'outfile', nargs='?', metavar='OUTFILE', help='set new result location' )
+	command_line_parser.add_argument( 'outfile', nargs='*', metavar='OUTFILE', help='set new result location (one per --transcode format)' )
 
 	command_line_tag_group = command_line_parser.add_argument_group( 'tag' )
 	command_line_tag_group.add_argument( '-d', '--discard', action='store_true', help='discard existing tag data' )
@@ -1093,8 +2149,12 @@ def main( argv=None ):
 	command_line_tag_group.add_argument( '-y', '--year', type=int, help='set year field', metavar='INT' )
 	command_line_tag_group.add_argument( '-c', '--comment', help='set comment field', metavar='STRING' )
 	command_line_tag_group.add_argument( '-C', '--cover', help='set cover art field', metavar='FILENAME' )
+	command_line_tag_group.add_argument( '--padding', type=int, default=ID3V2_PADDING, help='padding reserved in rewritten ID3v2 tags (default: %(default)s)', metavar='BYTES' )
 
 	command_line_other_group = command_line_parser.add_argument_group( 'other' )
+	command_line_other_group.add_argument( '-j', '--jobs', type=int, default=THREAD_COUNT, help='number of files processed at once (default: usable CPUs, %(default)s)', metavar='INT' )
+	command_line_other_group.add_argument( '--backend', choices=( 'pipe', 'ffmpeg' ), default='pipe', help='run a decoder and encoders per job joined by pipes, or a single ffmpeg process that also writes the tag (default: %(default)s)' )
+	command_line_other_group.add_argument( '--trace', help='write the stages of every job as a Chrome/Perfetto trace', metavar='FILENAME' )
 	command_line_other_group.add_argument( '--no-nice', action='store_true', help='do not lower process priority' )
 
 	if argv is None:
@@ -1107,24 +2167,60 @@ def main( argv=None ):
 		print( 'ERROR: No file at input path!' )
 		return 1
 
-	# Check for same input and output
-	if command_line.outfile is not None and os.path.exists( command_line.outfile ) and os.path.samefile( command_line.infile, command_line.outfile ):
-		print( 'ERROR: Input and output paths cannot be the same. (Omit second parameter for in-place editing.)' )
+	# One output location per format
+	if len( command_line.outfile ) > max( 1, len( command_line.transcode ) ) or ( len( command_line.outfile ) > 0 and len( command_line.transcode ) > 1 and len( command_line.outfile ) != len( command_line.transcode ) ):
+		print( 'ERROR: Give one output location per --transcode format!' )
 		return 1
+	if len( set( command_line.transcode ) ) != len( command_line.transcode ):
+		print( 'ERROR: Each --transcode format can only be given once!' )
+		return 1
+
+	for outfile in command_line.outfile:
+		# Check for same input and output
+		if os.path.exists( outfile ) and os.path.samefile( command_line.infile, outfile ):
+			print( 'ERROR: Input and output paths cannot be the same. (Omit second parameter for in-place editing.)' )
+			return 1
+
+		# Check for directory
+		if os.path.exists( outfile ) and ( os.path.isdir( command_line.infile ) != os.path.isdir( outfile ) ):
+			print( 'ERROR: Cannot mix files and directories!' )
+			return 1
+
+		# Don't overwrite existing files
+		if os.path.isfile( outfile ) and not command_line.force:
+			print( 'ERROR: File exists at output path!' )
+			return 1
 
 	# Check for directory
 	if os.path.isdir( command_line.infile ) and not command_line.recursive:
 		print( 'ERROR: For security --recursive must be used on directory inputs!' )
 		return 1
-	if command_line.outfile is not None and os.path.exists( command_line.outfile ) and ( os.path.isdir( command_line.infile ) != os.path.isdir( command_line.outfile ) ):
-		print( 'ERROR: Cannot mix files and directories!' )
+
+	# Need at least one worker
+	if command_line.jobs < 1:
+		print( 'ERROR: --jobs must be at least 1!' )
 		return 1
 
-	# Don't overwrite existing files
-	if command_line.outfile is not None and os.path.isfile( command_line.outfile ) and not command_line.force:
-		print( 'ERROR: File exists at output path!' )
+	# Incremental runs need a tree to transcode
+	if command_line.incremental and ( len( command_line.transcode ) == 0 or not os.path.isdir( command_line.infile ) ):
+		print( 'ERROR: --incremental requires --transcode and a directory input!' )
+		return 1
+	if command_line.manifest is not None and len( command_line.transcode ) > 1:
+		print( 'ERROR: --manifest cannot be used with several --transcode formats!' )
+		return 1
+
+	# Probe the codec tools once, before any job needs them
+	if command_line.backend == 'ffmpeg' and find_tool( 'ffmpeg' ) is None:
+		print( 'ERROR: The ffmpeg backend needs ffmpeg on the PATH!' )
+		return 1
+	missing = probe_backends( [ FORMAT_EXT_MAP[transcode] for transcode in command_line.transcode ], command_line.backend )
+	if len( missing ) > 0:
+		print( 'ERROR: No encoder found for the ' + ', '.join( missing ) + ' format!' )
 		return 1
 
+	if command_line.trace is not None:
+		start_trace()
+
 	# Reduce priority
 	if not command_line.no_nice:
 		os.nice( 10 )
@@ -1150,126 +2246,155 @@ def main( argv=None ):
 	if command_line.cover is not None:
 		new_tag['cover'] = command_line.cover
 
+	# Load manifests of previous incremental runs, one per output tree
+	manifests = None
+	if command_line.incremental:
+		if command_line.manifest is not None:
+			manifest_paths = [ command_line.manifest ]
+		elif len( command_line.outfile ) > 0:
+			manifest_paths = [ os.path.join( outfile, MANIFEST_FILENAME ) for outfile in command_line.outfile ]
+		elif len( command_line.transcode ) == 1:
+			manifest_paths = [ os.path.join( command_line.infile, MANIFEST_FILENAME ) ]
+		else:
+			# In-place formats share the input tree
+			manifest_paths = [ os.path.join( command_line.infile, os.path.splitext( MANIFEST_FILENAME )[0] + '-' + transcode + '.json' ) for transcode in command_line.transcode ]
+		manifests = [ load_manifest( manifest_path ) for manifest_path in manifest_paths ]
+		manifest_keys = set()
+
+	# Outputs recorded by earlier incremental runs in place share the input tree, but are not sources to transcode again
+	outputs = frozenset()
+	if manifests is not None and len( command_line.outfile ) == 0:
+		outputs = frozenset( os.path.normpath( os.path.join( command_line.infile, os.path.splitext( key )[0] + record['format'] ) ) for manifest in manifests for key, record in manifest.items() if os.path.splitext( key )[0] + record['format'] != key )
+
 	# Execute/generate main task
-	with concurrent.futures.ThreadPoolExecutor( THREAD_COUNT ) as executor:
-		jobs = list()
-		if command_line.outfile is None:
-			# inplace
-			if os.path.isfile( command_line.infile ):
-				# non recursive
-				if command_line.discard:
-					tag = new_tag
-				else:
-					tag = get_tag( command_line.infile )
-					tag.update( new_tag )
-				tag = { k:v for k, v in tag.items() if ( v != 0 or len( v ) > 0 ) }
-				if command_line.transcode is None:
-					# don't transcode
-					set_tag( command_line.infile, tag )
+	with concurrent.futures.ThreadPoolExecutor( command_line.jobs, 'job' ) as executor, concurrent.futures.ThreadPoolExecutor( command_line.jobs, 'tag' ) as tag_executor:
+		walker = walk_jobs( command_line.infile, tuple( command_line.outfile ), tuple( command_line.transcode ), command_line.force, command_line.incremental, outputs )
+		tag_jobs = dict()
+		ready = list()
+		jobs = dict()
+		retags = dict()
+		sequence = 0
+		planned = 0
+		counter = 0
+		failed = 0
+		while True:
+			# Read tags ahead of the encoders, within bounds (tag and copy jobs are submitted as soon as their tag is read)
+			while walker is not None and len( tag_jobs ) < 2 * command_line.jobs and len( jobs ) < 2 * command_line.jobs and len( ready ) < PIPELINE_WINDOW:
+				with trace_stage( 'walk' ):
+					job = next( walker, None )
+				if job is None:
+					walker = None
+				elif job[2] == 'transcode' and manifests is not None:
+					key = os.path.relpath( job[0], command_line.infile )
+					manifest_keys.add( key )
+					tag_jobs[tag_executor.submit( traced_job, 'get_tag', job[0], time.perf_counter(), gather_tag_records, job[0], new_tag, command_line.discard, [ os.path.splitext( out_path )[1].lower() for out_path in job[1] ], [ manifest.get( key ) for manifest in manifests ], command_line.backend )] = job
+				elif job[2] == 'copy':
+					tag_jobs[tag_executor.submit( traced_job, 'get_tag', job[0], time.perf_counter(), gather_tag_change, job[0], new_tag, command_line.discard )] = job
 				else:
-					# transcode
-					new_path = os.path.splitext( command_line.infile )[0] + FORMAT_EXT_MAP[command_line.transcode]
-					if not os.path.exists( new_path ) or command_line.force:
-						jobs.append( executor.submit( convert_audio_format, command_line.infile, new_path, tag ) )
+					tag_jobs[tag_executor.submit( traced_job, 'get_tag', job[0], time.perf_counter(), gather_tag, job[0], new_tag, command_line.discard )] = job
+
+			# Feed the encoders, longest job in the window first
+			while len( ready ) > 0 and len( jobs ) < command_line.jobs:
+				cost, seq, in_path, out_paths, tag, manifest_entry, queued = heapq.heappop( ready )
+				# Spread spare CPUs over multithreaded encoders once there are fewer jobs left than CPUs
+				threads = 1 if walker is not None else max( 1, THREAD_COUNT // min( command_line.jobs, len( jobs ) + len( ready ) + 1 ) )
+				jobs[executor.submit( traced_job, 'transcode', in_path, queued, convert_audio_format, in_path, out_paths, tag, threads, command_line.backend )] = ( in_path, manifest_entry )
+
+			if len( tag_jobs ) == 0 and len( jobs ) == 0 and len( ready ) == 0 and walker is None:
+				break
+
+			done, not_done = concurrent.futures.wait( list( tag_jobs ) + list( jobs ), return_when=concurrent.futures.FIRST_COMPLETED )
+			for future in done:
+				if future in tag_jobs:
+					in_path, out_paths, mode = tag_jobs.pop( future )
+					if future.exception() is not None:
+						# Unreadable files count as failed jobs rather than ending the run
+						counter += 1
+						planned += 1
+						failed += 1
+						print( 'ERROR: Failed to process ("', in_path, '"): ', future.exception(), sep=str(), file=sys.stderr )
+					elif mode == 'tag':
+						jobs[executor.submit( traced_job, 'set_tag', in_path, time.perf_counter(), set_tag, in_path, future.result(), command_line.padding )] = ( in_path, None )
+						planned += 1
+					elif mode == 'copy':
+						tag, changed = future.result()
+						jobs[executor.submit( traced_job, 'copy', in_path, time.perf_counter(), copy_with_tag, in_path, out_paths[0], tag, command_line.padding, changed )] = ( in_path, None )
+						planned += 1
 					else:
-						print( 'WARNING: Cannot overwrite ("', new_path, '") existing file without --force.  Cancelling...', sep=str() )
-			else:
-				# recursive
-				for dirname, dirnames, filenames in os.walk( command_line.infile ):
-					for filename in filenames:
-						path = os.path.join( dirname, filename )
-						head, tail = os.path.splitext( path )
-						if tail.lower() in FORMAT_EXT_MAP.values():
-							if command_line.discard:
-								tag = new_tag
-							else:
-								tag = get_tag( path )
-								tag.update( new_tag )
-							tag = { k:v for k, v in tag.items() if ( v != 0 or len( v ) > 0 ) }
-							if command_line.transcode is None:
-								# don't transcode
-								set_tag( path, tag )
-							else:
-								# transcode
-								new_path = head + FORMAT_EXT_MAP[command_line.transcode]
-								if not os.path.exists( new_path ) or command_line.force:
-									jobs.append( executor.submit( convert_audio_format, path, new_path, tag ) )
+						if manifests is None:
+							tag = future.result()
+							targets = [ ( out_path, None ) for out_path in out_paths ]
+						else:
+							# Only produce the formats whose output is out of date
+							tag, records = future.result()
+							key = os.path.relpath( in_path, command_line.infile )
+							targets = list()
+							for out_path, manifest, record in zip( out_paths, manifests, records ):
+								# A source retagged in place is never adopted as its own output
+								if not command_line.force and ( out_path != in_path or key in manifest ) and is_up_to_date( out_path, record, manifest.get( key ), tag ):
+									manifest[key] = record
 								else:
-									print( 'WARNING: Cannot overwrite ("', new_path, '") existing file without --force.  Skipping...', sep=str() )
-		else:
-			# new file
-			if os.path.isfile( command_line.infile ):
-				# non recursive
-				if command_line.discard:
-					tag = new_tag
-				else:
-					tag = get_tag( command_line.infile )
-					tag.update( new_tag )
-				tag = { k:v for k, v in tag.items() if ( v != 0 or len( v ) > 0 ) }
-				if command_line.transcode is None and os.path.splitext( command_line.infile )[1].lower() == os.path.splitext( command_line.outfile )[1].lower():
-					# don't transcode
-					if not os.path.exists( command_line.outfile ) or command_line.force:
-						shutil.copy( command_line.infile, command_line.outfile )
-						set_tag( command_line.outfile, tag )
-					else:
-						print( 'WARNING: Cannot overwrite ("', command_line.outfile, '") existing file without --force.  Skipping...', sep=str() )
-				else:
-					# transcode
-					if not os.path.exists( command_line.outfile ) or command_line.force:
-						jobs.append( executor.submit( convert_audio_format, command_line.infile, command_line.outfile, tag ) )
-					else:
-						print( 'WARNING: Cannot overwrite ("', command_line.outfile, '") existing file without --force.  Cancelling...', sep=str() )
-			else:
-				# recursive
-				if command_line.transcode is None:
-					# don't transcode
-					for old_dirpath, dirnames, filenames in os.walk( command_line.infile ):
-						new_dirpath = os.path.normpath( os.path.join( command_line.outfile, os.path.relpath( old_dirpath, command_line.infile ) ) )
-						if not os.path.exists( new_dirpath ):
-							os.mkdir( new_dirpath )
-						for filename in filenames:
-							old_path = os.path.join( old_dirpath, filename )
-							new_path = os.path.join( new_dirpath, filename )
-							if command_line.discard:
-								tag = new_tag
+									targets.append( ( out_path, ( manifest, key, record ) ) )
+						# Retag or copy outputs already in the format of the source instead of encoding them
+						encode_targets = list()
+						retag = None
+						for out_path, record_entry in targets:
+							out_ext = os.path.splitext( out_path )[1].lower()
+							if out_path != in_path and ( command_line.reencode or out_ext != os.path.splitext( in_path )[1].lower() ):
+								encode_targets.append( ( out_path, record_entry ) )
+							elif out_path == in_path and record_entry is None:
+								retag = ( set_tag, ( in_path, tag, command_line.padding ), None )
+							elif out_path == in_path:
+								# The retag changes the source, so its record is made afterwards
+								retag = ( retag_record, ( in_path, tag, command_line.padding, command_line.backend ), [ record_entry[0:2] + ( None, ) ] )
+							elif out_ext in RETAG_FORMATS:
+								jobs[executor.submit( traced_job, 'copy', in_path, time.perf_counter(), copy_with_tag, in_path, out_path, tag, command_line.padding )] = ( in_path, None if record_entry is None else [ record_entry ] )
+								planned += 1
 							else:
-								tag = get_tag( old_path )
-								tag.update( new_tag )
-							tag = { k:v for k, v in tag.items() if ( v != 0 or len( v ) > 0 ) }
-							if not os.path.exists( new_path ) or command_line.force:
-								shutil.copy( old_path, new_path )
-								set_tag( new_path, tag )
-							else:
-								print( 'WARNING: Cannot overwrite ("', new_path, '") existing file without --force.  Skipping...', sep=str() )
+								# No tag writer for the format, so only a copy that keeps the tag avoids a lossy re-encode
+								jobs[executor.submit( traced_job, 'copy', in_path, time.perf_counter(), clone_or_convert, in_path, out_path, tag, command_line.backend )] = ( in_path, None if record_entry is None else [ record_entry ] )
+								planned += 1
+						if retag is not None and len( encode_targets ) > 0:
+							# The encoders read the source, so it is only retagged once they are done
+							retags[in_path] = retag
+							planned += 1
+						elif retag is not None:
+							jobs[executor.submit( traced_job, 'set_tag', in_path, time.perf_counter(), retag[0], *retag[1] )] = ( in_path, retag[2] )
+							planned += 1
+						if len( encode_targets ) > 0:
+							manifest_entry = None if manifests is None else [ record_entry for out_path, record_entry in encode_targets ]
+							heapq.heappush( ready, ( -estimate_job_cost( in_path ) * len( encode_targets ), sequence, in_path, tuple( out_path for out_path, record_entry in encode_targets ), tag, manifest_entry, time.perf_counter() ) )
+							sequence += 1
+							planned += 1
 				else:
-					# transcode
-					for old_dirpath, dirnames, filenames in os.walk( command_line.infile ):
-						new_dirpath = os.path.normpath( os.path.join( command_line.outfile, os.path.relpath( old_dirpath, command_line.infile ) ) )
-						if not os.path.exists( new_dirpath ):
-							os.mkdir( new_dirpath )
-						for filename in filenames:
-							old_path = os.path.join( old_dirpath, filename )
-							new_path = os.path.join( new_dirpath, os.path.splitext( filename )[0] + FORMAT_EXT_MAP[command_line.transcode] )
-							if command_line.discard:
-								tag = new_tag
-							else:
-								tag = get_tag( old_path )
-								tag.update( new_tag )
-							tag = { k:v for k, v in tag.items() if ( v != 0 or len( v ) > 0 ) }
-							if not os.path.exists( new_path ) or command_line.force:
-								jobs.append( executor.submit( convert_audio_format, old_path, new_path, tag ) )
-							else:
-								print( 'WARNING: Cannot overwrite ("', new_path, '") existing file without --force.  Skipping...', sep=str() )
-
-		counter = 0
-		for job in concurrent.futures.as_completed( jobs ):
-			counter += 1
-			time_left = round( ( time.time() - process_start_time ) / counter * len( jobs ) - ( time.time() - process_start_time ) )
-			print( 'Progress =', counter, '/', len( jobs ), ';', 'about', str( time_left // 3600 ).zfill( 1 ) + ':' + str( time_left // 60 % 60 ).zfill( 2 ) + ':' + str( time_left % 60 ).zfill( 2 ), 'left', flush=True )
+					in_path, manifest_entry = jobs.pop( future )
+					counter += 1
+					if in_path in retags:
+						retag = retags.pop( in_path )
+						jobs[executor.submit( traced_job, 'set_tag', in_path, time.perf_counter(), retag[0], *retag[1] )] = ( in_path, retag[2] )
+					if future.exception() is not None:
+						failed += 1
+						print( 'ERROR: Failed to process ("', in_path, '"): ', future.exception(), sep=str(), file=sys.stderr )
+					elif manifest_entry is not None:
+						for manifest, key, record in manifest_entry:
+							manifest[key] = future.result() if record is None else record
+					time_left = round( ( time.time() - process_start_time ) / counter * planned - ( time.time() - process_start_time ) )
+					print( 'Progress =', counter, '/', planned, ';', 'about', str( time_left // 3600 ).zfill( 1 ) + ':' + str( time_left // 60 % 60 ).zfill( 2 ) + ':' + str( time_left % 60 ).zfill( 2 ), 'left', flush=True )
+
+	# Save manifests, forgetting sources that are gone
+	if manifests is not None:
+		for manifest_path, manifest in zip( manifest_paths, manifests ):
+			save_manifest( manifest_path, { k:v for k, v in manifest.items() if k in manifest_keys } )
+
+	if command_line.trace is not None:
+		save_trace( command_line.trace )
 
 	# Done
 	process_time = round( time.time() - process_start_time )
 	print( 'Finished. Process took', process_time // 3600, 'hours,', process_time // 60 % 60, 'minutes, and', process_time % 60, 'seconds.' )
+	if failed > 0:
+		print( 'ERROR:', failed, 'of', planned, 'jobs failed!', file=sys.stderr )
+		return 1
 	return 0
 
 if __name__ == '__main__':